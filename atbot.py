@@ -0,0 +1,179 @@
+'''
+This module implement asyncio variant of BotHandler, handlers of different chats run concurrently.
+
+Classes:
+    AsyncBotHandler : asyncio bot to work with telegram api
+'''
+
+from typing import List, Dict
+from collections import OrderedDict
+import asyncio
+import json
+import time
+
+import aiohttp
+
+import metrics
+from tbot import InlineButton, Message, Callback, Dispatcher, update_chat_id
+
+
+class AsyncBotHandler:
+    '''
+    Class that help works with telegram bot API from asyncio.
+    Updates from one getUpdates batch are handled concurrently,
+    updates of the same chat are handled in order they came.
+    '''
+
+    def __init__(self, token : str, server : str = 'https://api.telegram.org', pool_size : int = 100,
+                 timeout : float = 10, bot_name : str = None):
+        '''
+        Bot constructor.
+        pool_size limits number of simultaneous connections to bot API.
+        bot_name is used to skip commands addressed to other bots.
+        '''
+        self.token = token
+        self.api_url = "{}/bot{}/".format(server.rstrip('/'), token)
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._offset = None
+        self.dispatcher = Dispatcher(bot_name)
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        '''
+        Create session on first use, it must be created inside running loop.
+        '''
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self) -> None:
+        '''
+        Close session and all pooled connections.
+        '''
+        if self._session is not None:
+            await self._session.close()
+
+    async def _call(self, method : str, params : Dict, timeout : float = None) -> Dict:
+        '''
+        Call bot API method and return answer json.
+        '''
+        data = {k: str(v) for k, v in params.items() if v is not None}
+        timeout = aiohttp.ClientTimeout(total=timeout or self.timeout)
+        start = time.perf_counter()
+        try:
+            async with self._get_session().post(self.api_url + method, data=data, timeout=timeout) as resp:
+                if resp.status == 429:
+                    metrics.counter('api_too_many_requests_total', method=method).inc()
+                return await resp.json()
+        except Exception:
+            metrics.counter('api_errors_total', method=method).inc()
+            raise
+        finally:
+            metrics.histogram('api_request_seconds', method=method).observe(time.perf_counter() - start)
+
+    async def get_updates(self, offset : int = None, timeout : int = 30) -> Dict:
+        '''
+        Get updates from telegram bot.
+        '''
+        params = {'timeout': timeout, 'offset': offset}
+        result_json = await self._call('getUpdates', params, timeout=self.timeout + timeout)
+        return result_json['result']
+
+    async def send_message(self, chat_id : int, text : str, markup = None) -> Dict:
+        '''
+        Send message to chat.
+        '''
+        params = {'chat_id': chat_id, 'text': text, 'reply_markup' : markup}
+        return await self._call('sendMessage', params)
+
+    async def send_inline_keyboard(self, chat_id : int, text : str, buttons : List[List[InlineButton]]) -> Dict:
+        '''
+        Send inline keyboard to chat.
+        '''
+        buttons = [[j.button_dict for j in i] for i in buttons]
+        markup = json.dumps({"inline_keyboard" : buttons })
+        return await self.send_message(chat_id, text, markup)
+
+    async def edit_message(self, chat_id : int, message_id : int, text : str, markup = None) -> Dict:
+        '''
+        Edit message in chat.
+        '''
+        params = {'chat_id': chat_id, 'message_id' : message_id, 'text': text, 'reply_markup' : markup}
+        return await self._call('editMessageText', params)
+
+    async def get_last_updates(self, timeout : int = 30) -> Dict:
+        '''
+        Get last updates from telegram bot.
+        '''
+        result_json = await self.get_updates(offset=self._offset, timeout=timeout)
+        if len(result_json) > 0:
+            last_update_id = result_json[-1]['update_id']
+            self._offset = last_update_id + 1
+        else:
+            raise ValueError('Empty result!')
+        return result_json
+
+    async def _handle_chat_updates(self, updates : List[Dict]) -> None:
+        '''
+        Run handlers for updates of one chat one after another.
+        '''
+        for i in updates:
+            if i.get('message', False):
+                msg = Message(i['message'])
+                for j in self.dispatcher.message_handlers(msg):
+                    await j(msg)
+            elif i.get('callback_query', False):
+                clbk = Callback(i['callback_query'])
+                for j in self.dispatcher.callback_handlers(clbk):
+                    await j(clbk)
+
+    async def process_updates(self, updates : List[Dict]) -> None:
+        '''
+        Group updates by chat and handle chats concurrently.
+        '''
+        chats = OrderedDict()
+        for i in updates:
+            chat_id = update_chat_id(i)
+            if chat_id is not None:
+                chats.setdefault(chat_id, []).append(i)
+        await asyncio.gather(*(self._handle_chat_updates(i) for i in chats.values()))
+
+    async def polling(self, timeout : int = 200) -> None:
+        '''
+        Bot polling routine.
+        '''
+        try:
+            updates = await self.get_last_updates(timeout)
+        except ValueError:
+            return
+        await self.process_updates(updates)
+
+
+    def recieve_message_decorator(self, func):
+        '''
+        Decorator for coroutine functions that wait for recieve a message.
+        '''
+        self.dispatcher.add_message_handler(func)
+        return func
+
+
+    def recieve_command_decorator(self, command : str):
+        '''
+        Decorator fabric for coroutine function that waiting to recieve command.
+        '''
+        def decorator(func):
+            self.dispatcher.add_command_handler(command, func)
+            return func
+        return decorator
+
+
+    def recieve_callback_decorator(self, callback_handler_name = None):
+        '''
+        Decorator for coroutine functions that wait for recieve a callback.
+        '''
+        def decorator(func):
+            self.dispatcher.add_callback_handler(callback_handler_name, func)
+            return func
+        return decorator
@@ -0,0 +1,741 @@
+'''
+This module implements benchmarks for birthday bot components.
+
+Usage:
+    python benchmark.py database|http|async|routing|sender|memory|scheduler|webhook|supervisor|callback|writes [-n COUNT]
+    python benchmark.py calendar -n 1000000 [--chats CHATS] [--db bench.db]
+    python benchmark.py webhook --updates updates.jsonl
+    python benchmark.py suite -n 1000000 [--chats CHATS] [--db bench.db] [--json results.json]
+
+Results of any benchmark are written as json with --json, to compare them between runs.
+
+Functions:
+    bench_database : compare connection per call with persistent connections
+    bench_http : compare round trip of new connection per request with pooled session
+    bench_async : compare update throughput of BotHandler and AsyncBotHandler
+    bench_routing : compare linear handler scan with Dispatcher lookup
+    bench_sender : drain celebration batch through SendQueue
+    bench_memory : compare peak memory of dict rows, Birthday records and streaming
+    bench_scheduler : measure BirthdayScheduler load, add, remove and daily pop
+    bench_webhook : replay updates to WebhookServer and measure updates/sec
+    bench_supervisor : measure updates/sec of Supervisor with different number of workers
+    bench_callback : compare encode and decode cost of dict repr and CallbackCodec callback_data
+    bench_writes : compare writes/sec of transaction per write and writer thread group commit
+    generate_birthdays : synthetic (name, birth_date, chat_id) rows
+    populate : fill database with synthetic birthdays
+    latency : per call latency percentiles
+    bench_db_ops : measure latency of Database operations
+    rss_mib : resident memory of process
+    bench_calendar : measure CalendarIndex load time, memory and lookups against SQLite
+    bench_sweep : measure scheduler load and daily celebration of main.py
+    bench_polling : measure updates/sec of main.py handlers through BotHandler.polling
+    bench_suite : populate database and run db ops, sweep and polling benchmarks on it
+'''
+
+from typing import Callable, Dict, Generator, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import datetime
+import gc
+import json
+import os
+import platform
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import requests
+
+from atbot import AsyncBotHandler
+from database import Database, Birthday, BIRTHDAY_FIELDS, INSERT_BIRTHDAY
+from fakeapi import FakeTelegramAPI
+from importer import import_birthdays
+from scheduler import BirthdayScheduler
+from sender import SendQueue
+from supervisor import Supervisor
+from tbot import BotHandler, Callback, CallbackCodec, Dispatcher, InlineButton, Message, WebhookServer, SECRET_TOKEN_HEADER
+
+
+def measure(func : Callable, count : int) -> float:
+    '''
+    Call func(i) count times and return operations per second.
+    '''
+    start = time.perf_counter()
+    for i in range(count):
+        func(i)
+    return count / (time.perf_counter() - start)
+
+
+def bench_database(count : int = 2000) -> Dict:
+    '''
+    Compare ops/sec of old connection per call access with Database.
+    '''
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        old_name = os.path.join(tmp, 'old.db')
+        Database(old_name).close()
+        #old behaviour: rollback journal, new connection and fsync for every call
+        conn = sqlite3.connect(old_name)
+        conn.execute('PRAGMA journal_mode=DELETE')
+        conn.close()
+
+        def old_add(i):
+            conn = sqlite3.connect(old_name)
+            conn.execute('INSERT INTO birthdays (hash, name, date, chat_id, month, day) VALUES (?,?,?,?,?,?)',
+                (f'name{i}:{i % 100}', f'name{i}', '01.01.2000', i % 100, 1, 1))
+            conn.commit()
+            conn.close()
+
+        def old_get(i):
+            conn = sqlite3.connect(old_name)
+            conn.execute('SELECT name, date, chat_id FROM birthdays WHERE name=? AND chat_id=?', (f'name{i}', i % 100)).fetchone()
+            conn.close()
+
+        results['old'] = {'add': measure(old_add, count), 'get': measure(old_get, count)}
+
+        db = Database(os.path.join(tmp, 'new.db'))
+        results['new'] = {
+            'add': measure(lambda i: db.add_birthday(f'name{i}', '1.1.2000', i % 100), count),
+            'get': measure(lambda i: db.get_birthday(f'name{i}', i % 100), count),
+            }
+        start = time.perf_counter()
+        db.add_birthdays((f'bulk{i}', '1.1.2000', i % 100) for i in range(count))
+        results['new']['add_birthdays'] = count / (time.perf_counter() - start)
+        db.close()
+    return results
+
+
+def bench_http(count : int = 2000) -> Dict:
+    '''
+    Compare sendMessage round trip latency to local fake API, result in milliseconds.
+    '''
+    api = FakeTelegramAPI().start()
+    bot = BotHandler('token', server=api.server_url)
+    try:
+        params = {'chat_id': 1, 'text': 'text'}
+        results = {
+            'old': 1000 / measure(lambda i: requests.post(bot.api_url + 'sendMessage', data=params), count),
+            'new': 1000 / measure(lambda i: bot.send_message(1, 'text'), count),
+            }
+    finally:
+        bot.close()
+        api.stop()
+    return results
+
+
+def bench_async(count : int = 2000, chats : int = 50, latency : float = 0.005) -> Dict:
+    '''
+    Compare updates/sec of sync and async bots, every update is answered with one message.
+    latency is fake API answer delay in seconds.
+    '''
+    results = {}
+    api = FakeTelegramAPI(latency=latency).start()
+    try:
+        bot = BotHandler('token', server=api.server_url)
+
+        @bot.recieve_command_decorator('/list')
+        def sync_handler(message):
+            bot.send_message(message.chat_id, 'list')
+
+        for i in range(count):
+            api.push_message(i % chats, '/list')
+        start = time.perf_counter()
+        while len(api.sent) < count:
+            bot.polling()
+        results['sync'] = count / (time.perf_counter() - start)
+        bot.close()
+
+        async_bot = AsyncBotHandler('token', server=api.server_url)
+        async_bot._offset = bot._offset
+
+        @async_bot.recieve_command_decorator('/list')
+        async def async_handler(message):
+            await async_bot.send_message(message.chat_id, 'list')
+
+        async def run():
+            try:
+                while len(api.sent) < 2*count:
+                    await async_bot.polling()
+            finally:
+                await async_bot.close()
+
+        for i in range(count):
+            api.push_message(i % chats, '/list')
+        start = time.perf_counter()
+        asyncio.run(run())
+        results['async'] = count / (time.perf_counter() - start)
+    finally:
+        api.stop()
+    return results
+
+
+def bench_routing(count : int = 100000, commands : int = 500) -> Dict:
+    '''
+    Compare messages/sec routed by old linear scan of command wrappers and by Dispatcher.
+    '''
+    calls = []
+    queue = []
+    dispatcher = Dispatcher()
+    for i in range(commands):
+        def wrapper(message, command=f'/cmd{i}'):
+            if command in message.text:
+                calls.append(message)
+        queue.append(wrapper)
+        dispatcher.add_command_handler(f'/cmd{i}', calls.append)
+    messages = [Message({'text': f'/cmd{i % commands} some arguments 1.1.2000'}) for i in range(count)]
+
+    def old_route(i):
+        msg = messages[i]
+        for j in queue:
+            j(msg)
+
+    def new_route(i):
+        msg = messages[i]
+        for j in dispatcher.message_handlers(msg):
+            j(msg)
+
+    return {'old': measure(old_route, count), 'new': measure(new_route, count)}
+
+
+def bench_sender(count : int = 300, chats : int = 100, latency : float = 0.02) -> Dict:
+    '''
+    Send count messages to chats through SendQueue, fake API answers 429
+    on more than one message per second to chat. Return sent messages/sec and SendQueue stats.
+    '''
+    api = FakeTelegramAPI(latency=latency, chat_interval=1).start()
+    bot = BotHandler('token', server=api.server_url)
+    queue = SendQueue(bot).start()
+    try:
+        start = time.perf_counter()
+        deliveries = [queue.send_message(i % chats, 'С днем рождения!') for i in range(count)]
+        enqueued = time.perf_counter() - start
+        for i in deliveries:
+            i.wait()
+        elapsed = time.perf_counter() - start
+    finally:
+        queue.stop()
+        bot.close()
+        api.stop()
+    return {'enqueue_ms': enqueued*1000, 'messages_per_sec': count/elapsed,
+            'api_429': api.too_many_requests, **queue.stats}
+
+
+def bench_memory(count : int = 1000000) -> Dict:
+    '''
+    Compare peak memory in MiB and time of get_all_birthdays with dict per row and with Birthday records.
+    '''
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'memory.db'))
+        db.add_birthdays((f'name{i}', f'{i % 28 + 1}.{i % 12 + 1}.{1950 + i % 60}', i % 1000) for i in range(count))
+
+        def old_get_all():
+            b_list = tuple(db.connection().execute('SELECT name, date, chat_id FROM birthdays'))
+            b_list = [dict(zip(BIRTHDAY_FIELDS, i)) for i in b_list]
+            return tuple(b_list)
+
+        def stream():
+            return sum(1 for _ in db.iter_all_birthdays())
+
+        def keyset():
+            return sum(len(i) for i in db.iter_birthdays_pages())
+
+        modes = (('old', old_get_all), ('new', db.get_all_birthdays), ('stream', stream), ('keyset', keyset))
+        for mode, func in modes:
+            tracemalloc.start()
+            start = time.perf_counter()
+            b_list = func()
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            del b_list
+            results[mode] = {'peak_mib': peak / 2**20, 'seconds': elapsed}
+        db.close()
+    return results
+
+
+def bench_scheduler(count : int = 1000000) -> Dict:
+    '''
+    Measure scheduling of count birthdays: load seconds, peak memory in MiB,
+    add and remove ops/sec and seconds to pop every day of a year.
+    '''
+    start_date = datetime.date(2021, 1, 1)
+    birthdays = [Birthday(f'name{i}', start_date + datetime.timedelta(days=i % 366) - datetime.timedelta(days=366*30), i % 1000)
+                 for i in range(count)]
+    scheduler = BirthdayScheduler(lambda b_list: None)
+    now = datetime.datetime.combine(start_date, datetime.time()).timestamp()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    scheduler.load(birthdays, now=now)
+    results = {'load_seconds': time.perf_counter() - start, 'peak_mib': tracemalloc.get_traced_memory()[1] / 2**20}
+    tracemalloc.stop()
+
+    extra = [Birthday(f'extra{i}', start_date, i) for i in range(10000)]
+    results['add_ops'] = measure(lambda i: scheduler.add(extra[i], now=now), len(extra))
+    results['remove_ops'] = measure(lambda i: scheduler.remove(extra[i].name, extra[i].chat_id), len(extra))
+
+    popped = 0
+    start = time.perf_counter()
+    for day in range(366):
+        popped += len(scheduler.pop_due(now + day*86400 + 3600))
+    results['pop_year_seconds'] = time.perf_counter() - start
+    results['popped'] = popped
+    return results
+
+
+def read_updates(file_name : str) -> List[Dict]:
+    '''
+    Read telegram updates, one json per line.
+    '''
+    with open(file_name, 'r', encoding='utf-8') as f:
+        return [json.loads(i) for i in f if i.strip()]
+
+
+def bench_webhook(count : int = 5000, updates : List[Dict] = None, clients : int = 8) -> Dict:
+    '''
+    Post updates to WebhookServer from clients threads, every update is answered
+    with one message to local fake API. Updates are replayed in a loop up to count.
+    '''
+    if not updates:
+        updates = [{'update_id': i, 'message': {'message_id': i, 'chat': {'id': i % 100, 'first_name': 'chat'},
+                    'from': {'first_name': 'first', 'last_name': 'last'}, 'text': '/list'}} for i in range(100)]
+    api = FakeTelegramAPI().start()
+    bot = BotHandler('token', server=api.server_url, pool_size=clients)
+
+    @bot.recieve_command_decorator('/list')
+    def handler(message):
+        bot.send_message(message.chat_id, 'list')
+
+    server = WebhookServer(bot, '127.0.0.1', 0, '/webhook', 'secret').start()
+    local = threading.local()
+
+    def post(i):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        #every post is new update, repeated update_id would be skipped as duplicate
+        update = dict(updates[i % len(updates)], update_id=i)
+        resp = session.post(server.server_url + '/webhook', json=update,
+                            headers={SECRET_TOKEN_HEADER: 'secret'})
+        return resp.status_code
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(clients) as executor:
+            statuses = list(executor.map(post, range(count)))
+        #updates are answered before they are handled, stop waits for queued ones
+        server.stop()
+        elapsed = time.perf_counter() - start
+    finally:
+        server.stop()
+        bot.close()
+        api.stop()
+    return {'updates_per_sec': count / elapsed, 'ok': statuses.count(200), 'sent': len(api.sent)}
+
+
+def bench_supervisor(count : int = 2000, workers = (1, 2, 4), latency : float = 0.005) -> Dict:
+    '''
+    Pass /list updates of 100 chats to Supervisor workers running main.py handlers,
+    return updates/sec for every number of workers.
+    '''
+    results = {}
+    api = FakeTelegramAPI(latency=latency).start()
+    environ = dict(os.environ)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.update({'TOKEN': 'token', 'TELEGRAM_API': api.server_url, 'DB_NAME': os.path.join(tmp, 'data.db')})
+        try:
+            for n in workers:
+                supervisor = Supervisor(n).start()
+                api.sent.clear()
+                updates = [{'update_id': i, 'message': {'message_id': i, 'chat': {'id': i % 100, 'first_name': 'chat'},
+                            'from': {'first_name': 'first', 'last_name': 'last'}, 'text': '/list'}} for i in range(count)]
+                start = time.perf_counter()
+                for i in range(0, count, 100):
+                    supervisor.process_updates(updates[i:i+100])
+                while len(api.sent) < count:
+                    time.sleep(0.01)
+                results[n] = count / (time.perf_counter() - start)
+                supervisor.stop()
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            api.stop()
+    return results
+
+
+def bench_callback(count : int = 100000) -> Dict:
+    '''
+    Compare microseconds per encode and decode of callback_data with dict repr
+    and with CallbackCodec, for short payloads and for long ones that go to registry.
+    '''
+    codec = CallbackCodec()
+    message = {'message_id': 1, 'chat': {'id': 1, 'first_name': 'chat'}, 'from': {'first_name': 'first', 'last_name': 'last'}}
+    payloads = {'short': [('del', f'Вася {i}') for i in range(count)],
+                'long': [('calc', f'Константин Константинопольский {i}') for i in range(count)]}
+    results = {}
+    for size, items in payloads.items():
+        old_data = [str({'handler': h, 'data': d}) for h, d in items]
+        new_data = [codec.encode(h, d) for h, d in items]
+
+        def old_decode(i):
+            data = json.loads(old_data[i].replace("'", '"'))
+            return data.get('handler'), data.get('data')
+
+        results[size] = {
+            'old_encode_us': 10**6 / measure(lambda i: str({'handler': items[i][0], 'data': items[i][1]}), count),
+            'new_encode_us': 10**6 / measure(lambda i: codec.encode(*items[i]), count),
+            'old_decode_us': 10**6 / measure(old_decode, count),
+            'new_decode_us': 10**6 / measure(lambda i: codec.decode(new_data[i]), count),
+            'callback_us': 10**6 / measure(lambda i: Callback({'id': '1', 'message': message, 'data': new_data[i]}), count),
+            'old_max_bytes': max(len(i.encode()) for i in old_data),
+            'new_max_bytes': max(len(i.encode()) for i in new_data),
+            }
+    return results
+
+
+def bench_writes(count : int = 5000, writers = (1, 8, 32)) -> Dict:
+    '''
+    Add count birthdays from writers threads, compare writes/sec of old transaction
+    per write on connection of every thread with Database writer thread group commit.
+    '''
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in writers:
+            db = Database(os.path.join(tmp, f'old{n}.db'))
+
+            def old_add(i):
+                values = db.birthday_row(f'name{i}', '1.1.2000', i % 100)
+                with db.connection() as conn:
+                    conn.execute(INSERT_BIRTHDAY, values)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(n) as executor:
+                list(executor.map(old_add, range(count)))
+            old = count / (time.perf_counter() - start)
+            db.close()
+
+            db = Database(os.path.join(tmp, f'new{n}.db'))
+            start = time.perf_counter()
+            with ThreadPoolExecutor(n) as executor:
+                list(executor.map(lambda i: db.add_birthday(f'name{i}', '1.1.2000', i % 100), range(count)))
+            new = count / (time.perf_counter() - start)
+            db.close()
+            results[n] = {'old': old, 'new': new}
+    return results
+
+
+def generate_birthdays(count : int, chats : int, seed : int = 0) -> Generator[Tuple[str, str, int], None, None]:
+    '''
+    Generate count synthetic birthdays spread over chats, birthday i is f'name{i}' in chat i % chats.
+    Dates are random but the same for the same seed.
+    '''
+    rnd = random.Random(seed)
+    start = datetime.date(1950, 1, 1).toordinal()
+    for i in range(count):
+        date = datetime.date.fromordinal(start + rnd.randrange(365*60))
+        yield f'name{i}', date.strftime('%d.%m.%Y'), i % chats
+
+
+def populate(db_name : str, count : int, chats : int, batch_size : int = 10000) -> Dict:
+    '''
+    Fill database with synthetic birthdays, skipped if it already has count rows.
+    '''
+    db = Database(db_name)
+    try:
+        rows = db.connection().execute('SELECT count(*) FROM birthdays').fetchone()[0]
+        if rows >= count:
+            return {'rows': rows, 'seconds': 0.0}
+        start = time.perf_counter()
+        added, _ = import_birthdays(db, generate_birthdays(count, chats), batch_size)
+        elapsed = time.perf_counter() - start
+    finally:
+        db.close()
+    return {'rows': rows + added, 'seconds': elapsed, 'rows_per_sec': added / elapsed}
+
+
+def latency(func : Callable, count : int) -> Dict:
+    '''
+    Call func(i) count times, return mean and percentiles of call latency in milliseconds.
+    '''
+    times = []
+    for i in range(count):
+        start = time.perf_counter()
+        func(i)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    percentile = lambda p: times[min(len(times) - 1, int(len(times)*p))]*1000
+    return {'mean_ms': sum(times)/len(times)*1000, 'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95), 'p99_ms': percentile(0.99)}
+
+
+def bench_db_ops(db_name : str, rows : int, chats : int, count : int = 2000) -> Dict:
+    '''
+    Measure latency of Database operations on database filled by populate.
+    '''
+    rnd = random.Random(1)
+    #birthday i lives in chat i % chats, see generate_birthdays
+    picks = [rnd.randrange(rows) for _ in range(count)]
+    db = Database(db_name)
+    try:
+        def cold_chat(i):
+            db.chat_cache.invalidate(picks[i] % chats)
+            db.get_chat_birthdays(picks[i] % chats)
+
+        def add_del(i):
+            db.add_birthday(f'bench{i}', '1.1.2000', picks[i] % chats)
+            db.del_birthday(f'bench{i}', picks[i] % chats)
+
+        dates = [f'{rnd.randrange(1, 29)}.{rnd.randrange(1, 13)}.2000' for _ in range(count)]
+        results = {
+            'get_chat_birthdays_cold': latency(cold_chat, count),
+            'get_chat_birthdays_warm': latency(lambda i: db.get_chat_birthdays(picks[i] % chats), count),
+            'get_birthday': latency(lambda i: db.get_birthday(f'name{picks[i]}', picks[i] % chats), count),
+            'search_names': latency(lambda i: db.search_names(picks[i] % chats, f'name{picks[i] // 10}'), count),
+            'search_birthdays': latency(lambda i: db.search_birthdays(picks[i] % chats, f'name{picks[i] // 10}', 20), count),
+            'get_upcoming': latency(lambda i: db.get_upcoming(picks[i] % chats, 7), count),
+            'add_del_birthday': latency(add_del, count),
+            'get_birthdays_by_date': latency(lambda i: db.get_birthdays_by_date(dates[i]), min(count, 100)),
+            }
+    finally:
+        db.close()
+    return results
+
+
+def rss_mib() -> float:
+    '''
+    Get resident memory of process in MiB, 0 where /proc is not available.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        return 0.0
+
+
+def bench_calendar(db_name : str, rows : int, chats : int, count : int = 2000) -> Dict:
+    '''
+    Measure startup load and resident memory of CalendarIndex on database filled by populate
+    and compare latency of day, upcoming and chat lookups with and without it.
+    '''
+    rnd = random.Random(1)
+    picks = [rnd.randrange(rows) % chats for _ in range(count)]
+    dates = [f'{rnd.randrange(1, 29)}.{rnd.randrange(1, 13)}.2000' for _ in range(count)]
+    db = Database(db_name, chat_cache_size=0)
+    try:
+        ops = {
+            'get_birthdays_by_date': (lambda i: db.get_birthdays_by_date(dates[i]), min(count, 100)),
+            'get_upcoming': (lambda i: db.get_upcoming(picks[i], 7), count),
+            'get_chat_birthdays': (lambda i: db.get_chat_birthdays(picks[i]), count),
+            }
+        results = {'sqlite': {op: latency(func, n) for op, (func, n) in ops.items()}}
+        gc.collect()
+        rss = rss_mib()
+        start = time.perf_counter()
+        db.load_calendar()
+        results['load_seconds'] = time.perf_counter() - start
+        gc.collect()
+        results['rss_mib'] = rss_mib() - rss
+        results['rows'] = len(db.calendar)
+        results['index'] = {op: latency(func, n) for op, (func, n) in ops.items()}
+    finally:
+        db.close()
+    return results
+
+
+def _import_main(db_name : str, api_url : str):
+    '''
+    Import main.py with bot pointed to fake API and selected database.
+    '''
+    #fake API numbers updates from 1 on every run, so offset is not kept
+    os.environ.update({'TOKEN': 'token', 'TELEGRAM_API': api_url, 'DB_NAME': db_name, 'OFFSET_FILE': ''})
+    import main
+    return main
+
+
+def bench_sweep(db_name : str, api_url : str = 'http://127.0.0.1:9') -> Dict:
+    '''
+    Measure path of the bot: scheduler load at start and celebration of today's birthdays
+    that scheduler pops at midnight, greetings are only queued, not sent.
+    '''
+    main = _import_main(db_name, api_url)
+    now = time.time()
+    start = time.perf_counter()
+    main.scheduler.load(main.db.iter_all_birthdays(), now)
+    load_seconds = time.perf_counter() - start
+    pending = main.send_queue.pending()
+    start = time.perf_counter()
+    #birthdays of today are due at once after load
+    main.birthday_handler.celebrate_due(main.scheduler.pop_due(now))
+    elapsed = time.perf_counter() - start
+    return {'load_seconds': load_seconds, 'seconds': elapsed, 'messages': main.send_queue.pending() - pending}
+
+
+def bench_polling(db_name : str, chats : int, count : int = 2000, latency : float = 0.0) -> Dict:
+    '''
+    Push count updates with mix of commands and callbacks from chats of populated database
+    and measure updates/sec of main.py handlers through BotHandler.polling.
+    latency is fake API answer delay in seconds.
+    '''
+    api = FakeTelegramAPI(latency=latency).start()
+    try:
+        main = _import_main(db_name, api.server_url)
+        main.my_bot.api_url = api.server_url + '/bottoken/'
+        commands = ('/list', '/calc', '/help', '/start', '/add bench{} 1.2.2000', '/del', 'calc')
+        last = None
+        for i in range(count):
+            chat_id = i % chats
+            command = commands[i % len(commands)]
+            if command == 'calc':
+                #name{chat_id} is in chat chat_id, see generate_birthdays
+                data = InlineButton('', f'name{chat_id}', 'calc').button_dict['callback_data']
+                last = api.push_update({'callback_query': {'id': str(i), 'data': data, 'message': {
+                    'message_id': 1, 'chat': {'id': chat_id, 'first_name': 'chat'},
+                    'from': {'first_name': 'first', 'last_name': 'last'}, 'text': ''}}})
+            else:
+                last = api.push_message(chat_id, command.format(i))
+        start = time.perf_counter()
+        while (main.my_bot._offset or 0) <= last:
+            main.my_bot.polling()
+        elapsed = time.perf_counter() - start
+    finally:
+        api.stop()
+    return {'updates_per_sec': count / elapsed, 'sent': len(api.sent)}
+
+
+def bench_suite(count : int, chats : int = None, db_name : str = None) -> Dict:
+    '''
+    Populate database with count birthdays and run db ops, sweep and polling benchmarks on it.
+    If db_name is set database is kept, so next runs skip populating.
+    '''
+    chats = chats or max(1, count // 20)
+    with tempfile.TemporaryDirectory() as tmp:
+        db_name = db_name or os.path.join(tmp, 'bench.db')
+        results = {'count': count, 'chats': chats, 'populate': populate(db_name, count, chats)}
+        results['db_ops'] = bench_db_ops(db_name, count, chats)
+        results['sweep'] = bench_sweep(db_name)
+        results['polling'] = bench_polling(db_name, chats)
+        import main as bot_main
+        bot_main.stop_services()
+    return results
+
+
+def write_json(file_name : str, benchmark : str, args : Dict, results : Dict) -> None:
+    '''
+    Write results with run parameters and environment to json file.
+    '''
+    report = {
+        'benchmark': benchmark,
+        'args': args,
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'results': results,
+        }
+    with open(file_name, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, default=str)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Birthday bot benchmarks.')
+    parser.add_argument('benchmark', choices=['database', 'calendar', 'http', 'async', 'routing', 'sender', 'memory', 'scheduler',
+                                              'webhook', 'supervisor', 'callback', 'writes', 'polling', 'suite'])
+    parser.add_argument('-n', '--count', type=int, default=2000)
+    parser.add_argument('--updates', default=None, help='json lines file with updates to replay')
+    parser.add_argument('--chats', type=int, default=None, help='number of synthetic chats, default count/20')
+    parser.add_argument('--db', default=None, help='keep synthetic database in this file between runs')
+    parser.add_argument('--json', default=None, help='write results to json file')
+    args = parser.parse_args()
+
+    results = None
+    if args.benchmark == 'database':
+        results = bench_database(args.count)
+        for mode, ops in results.items():
+            print(mode.center(50,'_'))
+            for op, value in ops.items():
+                print(f'{op}: {value:.0f} ops/sec')
+    elif args.benchmark == 'http':
+        results = bench_http(args.count)
+        for mode, value in results.items():
+            print(f'{mode}: {value:.3f} ms per sendMessage')
+    elif args.benchmark == 'async':
+        results = bench_async(args.count)
+        for mode, value in results.items():
+            print(f'{mode}: {value:.0f} updates/sec')
+    elif args.benchmark == 'routing':
+        results = bench_routing(args.count)
+        for mode, value in results.items():
+            print(f'{mode}: {value:.0f} messages/sec')
+    elif args.benchmark == 'sender':
+        results = bench_sender(args.count)
+        for key, value in results.items():
+            print(f'{key}: {value:.1f}')
+    elif args.benchmark == 'memory':
+        results = bench_memory(args.count)
+        for mode, value in results.items():
+            print(f'{mode}: peak {value["peak_mib"]:.1f} MiB, {value["seconds"]:.2f} s')
+    elif args.benchmark == 'scheduler':
+        results = bench_scheduler(args.count)
+        for key, value in results.items():
+            print(f'{key}: {value:.2f}')
+    elif args.benchmark == 'webhook':
+        updates = read_updates(args.updates) if args.updates else None
+        results = bench_webhook(args.count, updates)
+        for key, value in results.items():
+            print(f'{key}: {value:.1f}')
+    elif args.benchmark == 'supervisor':
+        results = bench_supervisor(args.count)
+        for workers, value in results.items():
+            print(f'{workers} workers: {value:.0f} updates/sec')
+    elif args.benchmark == 'callback':
+        results = bench_callback(args.count)
+        for size, values in results.items():
+            print(size.center(50,'_'))
+            for key, value in values.items():
+                print(f'{key}: {value:.2f}')
+    elif args.benchmark == 'writes':
+        results = bench_writes(args.count)
+        for writers, value in results.items():
+            print(f'{writers} writers: old {value["old"]:.0f} writes/sec, new {value["new"]:.0f} writes/sec')
+    elif args.benchmark == 'polling':
+        chats = args.chats or 100
+        with tempfile.TemporaryDirectory() as tmp:
+            db_name = args.db or os.path.join(tmp, 'bench.db')
+            populate(db_name, max(chats, 1000), chats)
+            results = bench_polling(db_name, chats, args.count)
+            import main as bot_main
+            bot_main.stop_services()
+        for key, value in results.items():
+            print(f'{key}: {value:.1f}')
+    elif args.benchmark == 'calendar':
+        chats = args.chats or max(1, args.count // 20)
+        with tempfile.TemporaryDirectory() as tmp:
+            db_name = args.db or os.path.join(tmp, 'bench.db')
+            populate(db_name, args.count, chats)
+            results = bench_calendar(db_name, args.count, chats, 2000)
+        print(f'{results["rows"]} birthdays in {chats} chats, index loaded in {results["load_seconds"]:.2f} s, '
+              f'{results["rss_mib"]:.0f} MiB resident')
+        for source in ('sqlite', 'index'):
+            print(source.center(50,'_'))
+            for op, value in results[source].items():
+                print(f'{op}: mean {value["mean_ms"]:.3f} ms, p50 {value["p50_ms"]:.3f} ms, p99 {value["p99_ms"]:.3f} ms')
+    elif args.benchmark == 'suite':
+        results = bench_suite(args.count, args.chats, args.db)
+        print(f'{results["populate"]["rows"]} birthdays in {results["chats"]} chats, '
+              f'populated in {results["populate"]["seconds"]:.1f} s')
+        for op, value in results['db_ops'].items():
+            print(f'{op}: mean {value["mean_ms"]:.3f} ms, p50 {value["p50_ms"]:.3f} ms, p99 {value["p99_ms"]:.3f} ms')
+        print(f'scheduler load: {results["sweep"]["load_seconds"]:.2f} s, '
+              f'daily celebration: {results["sweep"]["seconds"]*1000:.1f} ms, {results["sweep"]["messages"]} messages')
+        print(f'polling: {results["polling"]["updates_per_sec"]:.0f} updates/sec')
+    if args.json:
+        write_json(args.json, args.benchmark, vars(args), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+'''
+This module implements small in-process caches.
+
+Classes:
+    LRUCache : thread safe LRU cache with size and time to live bounds
+'''
+
+from typing import Any, Dict, Hashable
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache:
+    '''
+    Thread safe LRU cache. Holds at most maxsize values, every value lives at most ttl seconds.
+    Counts hits and misses.
+    '''
+
+    def __init__(self, maxsize : int = 1024, ttl : float = None):
+        '''
+        LRUCache constructor. If ttl is None values don't expire.
+        '''
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def generation(self) -> int:
+        '''
+        Number of invalidations, pass it to put to drop values read before invalidation.
+        '''
+        return self._generation
+
+    def get(self, key : Hashable, default : Any = None) -> Any:
+        '''
+        Get value by key, move it to the end of LRU order.
+        '''
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and (self.ttl is None or item[1] > time.monotonic()):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key : Hashable, value : Any, generation : int = None) -> None:
+        '''
+        Put value to cache, evict least recently used values above maxsize.
+        Value is dropped if cache was invalidated after generation.
+        '''
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key : Hashable) -> None:
+        '''
+        Remove value from cache.
+        '''
+        with self._lock:
+            self._generation += 1
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        '''
+        Remove all values from cache.
+        '''
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+
+    def info(self) -> Dict:
+        '''
+        Get hits, misses and size of cache.
+        '''
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
@@ -0,0 +1,152 @@
+'''
+This module implements in-memory index of birthdays by day of year.
+
+Classes:
+    CalendarIndex : 366 day buckets of compact birthday records
+'''
+
+from typing import Iterable, List, Tuple
+from array import array
+from bisect import bisect_left, bisect_right
+import datetime
+import threading
+
+from database import Birthday
+
+#(month, day) of every bucket, days of leap year so 29 February has own bucket
+DAYS = tuple((d.month, d.day) for d in (datetime.date(2000, 1, 1) + datetime.timedelta(days=i) for i in range(366)))
+DAY_INDEX = {day: i for i, day in enumerate(DAYS)}
+
+
+class _Bucket:
+    '''
+    Birthdays of one day sorted by chat_id, as parallel arrays.
+    '''
+    __slots__ = ('chat_ids', 'years', 'names')
+
+    def __init__(self):
+        self.chat_ids = array('q')
+        self.years = array('H')
+        self.names = []
+
+    def chat_range(self, chat_id : int) -> Tuple[int, int]:
+        return bisect_left(self.chat_ids, chat_id), bisect_right(self.chat_ids, chat_id)
+
+
+class CalendarIndex:
+    '''
+    Birthdays in 366 day buckets, every record is chat_id, year and name in parallel arrays
+    sorted by chat_id, so day, chat and day of chat lookups don't parse dates or touch database.
+    For every chat sorted numbers of buckets with its birthdays are kept, so chat lookup
+    visits only its days.
+    '''
+
+    def __init__(self):
+        self._buckets = [_Bucket() for _ in range(366)]
+        self._chat_buckets = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def load(self, rows : Iterable[Tuple[int, int, int, int, str]]) -> None:
+        '''
+        Replace index with (month, day, chat_id, year, name) rows in any order.
+        '''
+        buckets = [_Bucket() for _ in range(366)]
+        size = 0
+        for month, day, chat_id, year, name in rows:
+            bucket = buckets[DAY_INDEX[(month, day)]]
+            bucket.chat_ids.append(chat_id)
+            bucket.years.append(year)
+            bucket.names.append(name)
+            size += 1
+        #sort every bucket by chat once instead of ordered scan, it is several times slower in sqlite
+        chat_buckets = {}
+        for index, bucket in enumerate(buckets):
+            order = sorted(range(len(bucket.names)), key=bucket.chat_ids.__getitem__)
+            bucket.chat_ids = array('q', (bucket.chat_ids[i] for i in order))
+            bucket.years = array('H', (bucket.years[i] for i in order))
+            bucket.names = [bucket.names[i] for i in order]
+            for chat_id in dict.fromkeys(bucket.chat_ids):
+                days = chat_buckets.get(chat_id)
+                if days is None:
+                    chat_buckets[chat_id] = array('H', (index,))
+                else:
+                    days.append(index)
+        with self._lock:
+            self._buckets = buckets
+            self._chat_buckets = chat_buckets
+            self._size = size
+
+    def add(self, birthday : Birthday) -> None:
+        '''
+        Add birthday to its day bucket.
+        '''
+        date = birthday.date
+        index = DAY_INDEX[(date.month, date.day)]
+        with self._lock:
+            bucket = self._buckets[index]
+            i = bisect_right(bucket.chat_ids, birthday.chat_id)
+            bucket.chat_ids.insert(i, birthday.chat_id)
+            bucket.years.insert(i, date.year)
+            bucket.names.insert(i, birthday.name)
+            days = self._chat_buckets.setdefault(birthday.chat_id, array('H'))
+            i = bisect_left(days, index)
+            if i == len(days) or days[i] != index:
+                days.insert(i, index)
+            self._size += 1
+
+    def remove(self, name : str, chat_id : int) -> None:
+        '''
+        Remove birthday with name from chat, if there is one.
+        '''
+        with self._lock:
+            days = self._chat_buckets.get(chat_id, ())
+            for index in days:
+                bucket = self._buckets[index]
+                start, end = bucket.chat_range(chat_id)
+                for i in range(start, end):
+                    if bucket.names[i] == name:
+                        del bucket.chat_ids[i], bucket.years[i], bucket.names[i]
+                        self._size -= 1
+                        if end - start == 1:
+                            days.remove(index)
+                            if not days:
+                                del self._chat_buckets[chat_id]
+                        return
+
+    @staticmethod
+    def _records(bucket : _Bucket, month : int, day : int, start : int, end : int) -> List[Birthday]:
+        chat_ids, years, names = bucket.chat_ids, bucket.years, bucket.names
+        return [Birthday(names[i], datetime.date(years[i], month, day), chat_ids[i]) for i in range(start, end)]
+
+    def by_date(self, month : int, day : int) -> Tuple[Birthday, ...]:
+        '''
+        Get birthdays of day ordered by chat.
+        '''
+        with self._lock:
+            bucket = self._buckets[DAY_INDEX[(month, day)]]
+            return tuple(self._records(bucket, month, day, 0, len(bucket.names)))
+
+    def chat_days(self, chat_id : int, days : Iterable[Tuple[int, int]]) -> List[Birthday]:
+        '''
+        Get birthdays of chat on selected (month, day) days.
+        '''
+        result = []
+        with self._lock:
+            for month, day in days:
+                bucket = self._buckets[DAY_INDEX[(month, day)]]
+                start, end = bucket.chat_range(chat_id)
+                if start != end:
+                    result.extend(self._records(bucket, month, day, start, end))
+        return result
+
+    def chat(self, chat_id : int) -> Tuple[Birthday, ...]:
+        '''
+        Get all birthdays of chat ordered by day of year.
+        '''
+        with self._lock:
+            days = [DAYS[i] for i in self._chat_buckets.get(chat_id, ())]
+        return tuple(self.chat_days(chat_id, days))
@@ -2,41 +2,316 @@
 This module implements API for working with birthday database, its SQLite database.
 
 Classes:
+    Birthday
     Database
 '''
 
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Iterable, Optional, Generator, Callable
+from concurrent.futures import Future
+import calendar
 import datetime
-import re
+import queue
 import sqlite3
+import threading
+import time
+import weakref
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from cache import LRUCache
+from metrics import timed, counter
 
 BIRTHDAY_FIELDS = ('name','birth_date','chat_id')
+INSERT_BIRTHDAY = 'INSERT INTO birthdays (hash, name, date, chat_id, month, day, name_key) VALUES (?,?,?,?,?,?,?)'
+
+class Birthday:
+    '''
+    Compact birthday record, date is parsed once to datetime.date.
+    Fields from BIRTHDAY_FIELDS are also available as dict keys, e.g. birthday['birth_date'].
+    '''
+    __slots__ = ('name', 'date', 'chat_id')
+
+    def __init__(self, name : str, date : datetime.date, chat_id : int):
+        self.name = name
+        self.date = date
+        self.chat_id = chat_id
+
+    @classmethod
+    def from_row(cls, row : Tuple) -> 'Birthday':
+        '''
+        Create Birthday from (name, date, chat_id) database row.
+        '''
+        name, birth_date, chat_id = row
+        #stored dates are always dd.mm.yyyy, see Database.validate_date
+        return cls(name, datetime.date(int(birth_date[6:]), int(birth_date[3:5]), int(birth_date[:2])), chat_id)
+
+    @property
+    def birth_date(self) -> str:
+        '''
+        Date as string with format day.month.year .
+        '''
+        return self.date.strftime('%d.%m.%Y')
+
+    def __repr__(self):
+        return f'Birthday(name={self.name!r}, birth_date={self.birth_date!r}, chat_id={self.chat_id!r})'
+
+    def __eq__(self, other):
+        if not isinstance(other, Birthday):
+            return NotImplemented
+        return (self.name, self.date, self.chat_id) == (other.name, other.date, other.chat_id)
+
+    def __hash__(self):
+        return hash((self.name, self.date, self.chat_id))
+
+    def __getitem__(self, key : str):
+        if key not in BIRTHDAY_FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(BIRTHDAY_FIELDS)
+
+    def get(self, key : str, default = None):
+        return getattr(self, key) if key in BIRTHDAY_FIELDS else default
+
+    def keys(self) -> Tuple:
+        return BIRTHDAY_FIELDS
+
+    def as_dict(self) -> Dict:
+        return dict(self)
+
+
+class _ConnectionHolder:
+    '''
+    Connection of one thread, lives in thread local data, so it is freed when thread exits.
+    '''
+    __slots__ = ('conn', '__weakref__')
+
+    def __init__(self, conn : sqlite3.Connection):
+        self.conn = conn
+
+
+def _release_connection(connections : Dict, lock : threading.Lock, key : int) -> None:
+    '''
+    Close connection of exited thread.
+    '''
+    with lock:
+        conn = connections.pop(key, None)
+    if conn is not None:
+        conn.close()
+
 
 class Database:
     '''
     Class that implements layer between birthday_bot and sqlite database.
+    Every thread reads through its own persistent connection in WAL mode, it is closed when thread exits,
+    all writes go through one writer thread that commits them in groups.
     '''
     
-    def __init__(self, db_name : str):
+    def __init__(self, db_name : str, cache_size : int = 16000, chat_cache_size : int = 1024,
+                 chat_cache_ttl : float = 300, write_group_size : int = 256, write_window : float = 0,
+                 calendar_index : bool = False):
         '''
         Database constructor.
+        cache_size is sqlite page cache size in KiB for every connection.
+        Birthdays of chat_cache_size recently used chats are cached for chat_cache_ttl seconds.
+        Writer commits up to write_group_size writes in one transaction, it waits write_window seconds
+        for more writes, with 0 group is made of writes queued while previous group was committed.
+        With calendar_index birthdays are loaded to CalendarIndex and lookups by day and chat
+        are served from memory, it is kept in sync only with writes of this Database object.
         '''
         self.db_name = db_name
+        self.cache_size = cache_size
+        self.chat_cache = LRUCache(chat_cache_size, chat_cache_ttl)
+        self.write_group_size = write_group_size
+        self.write_window = write_window
+        self._local = threading.local()
+        #id of thread holder -> connection, holder is freed with thread local data on thread exit
+        self._connections = {}
+        self._connections_lock = threading.Lock()
+        self._writes = queue.Queue()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        conn = self.connection()
         try:
-            conn = sqlite3.connect(self.db_name)
-            c = conn.cursor()
-            c.execute('''CREATE TABLE "birthdays" (
-            "hash"	text NOT NULL UNIQUE,
-            "name"	text NOT NULL,
-            "date"	text NOT NULL,
-            "chat_id"	long NOT NULL
-            );''')
-            conn.commit()
+            with conn:
+                conn.execute('''CREATE TABLE "birthdays" (
+                "hash"	text NOT NULL UNIQUE,
+                "name"	text NOT NULL,
+                "date"	text NOT NULL,
+                "chat_id"	long NOT NULL,
+                "month"	integer,
+                "day"	integer,
+                "name_key"	text
+                );''')
         except sqlite3.OperationalError:
             print('Table already exists')
-        finally:
-            conn.close()
+        self.migrate()
+        self.calendar = None
+        if calendar_index:
+            self.load_calendar()
+
+    def connection(self) -> sqlite3.Connection:
+        '''
+        Get connection of current thread, open and tune it on first call.
+        '''
+        holder = getattr(self._local, 'holder', None)
+        if holder is not None:
+            return holder.conn
+        conn = sqlite3.connect(self.db_name, cached_statements=256, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        #in WAL mode NORMAL is safe from corruption and fsyncs only on checkpoint
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA cache_size=-{int(self.cache_size)}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA busy_timeout=5000')
+        holder = _ConnectionHolder(conn)
+        with self._connections_lock:
+            self._connections[id(holder)] = conn
+        #finalizer doesn't reference Database, so it doesn't keep it alive
+        weakref.finalize(holder, _release_connection, self._connections, self._connections_lock, id(holder))
+        self._local.holder = holder
+        return conn
+
+    def close(self):
+        '''
+        Commit queued writes, stop writer and close connections of all threads.
+        '''
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writes.put(None)
+                self._writer.join()
+                self._writer = None
+        with self._connections_lock:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def submit(self, func : Callable, *args) -> Future:
+        '''
+        Queue write func(connection, *args) to writer thread, return future with its result.
+        Writes of group share transaction, so func that raises must leave database unchanged,
+        single statement does it itself, several statements need savepoint.
+        '''
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name='db-writer', daemon=True)
+                self._writer.start()
+            future = Future()
+            self._writes.put((func, args, future))
+        return future
+
+    def _write_loop(self) -> None:
+        conn = self.connection()
+        while True:
+            item = self._writes.get()
+            if item is None:
+                return
+            group = [item]
+            deadline = time.monotonic() + self.write_window
+            stop = False
+            while len(group) < self.write_group_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._writes.get(timeout=timeout) if timeout > 0 else self._writes.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                group.append(item)
+            self._commit_group(conn, group)
+            if stop:
+                return
+
+    def _commit_group(self, conn : sqlite3.Connection, group : List[Tuple]) -> None:
+        '''
+        Run writes of group in one transaction, resolve futures after commit.
+        '''
+        results = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for func, args, future in group:
+                try:
+                    results.append((future, func(conn, *args), None))
+                except Exception as e:
+                    results.append((future, None, e))
+            conn.execute('COMMIT')
+        except Exception as e:
+            try:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass
+            for _, _, future in group:
+                future.set_exception(e)
+            return
+        counter('db_write_groups_total').inc()
+        counter('db_writes_total').inc(len(group))
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
 
+    def cache_info(self) -> Dict:
+        '''
+        Get hits, misses and size of chat birthdays cache.
+        '''
+        return self.chat_cache.info()
+
+    def migrate(self):
+        '''
+        Bring existing database to current schema.
+        Fill month, day and name_key columns, create indexes, chat timezones and celebrations tables.
+        Columns are checked under write lock, so processes migrating at once don't add them twice.
+        '''
+        conn = self.connection()
+        conn.create_function('name_key', 1, self.name_key, deterministic=True)
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            columns = [i[1] for i in conn.execute('PRAGMA table_info(birthdays)')]
+            for column, column_type in (('month', 'integer'), ('day', 'integer'), ('name_key', 'text')):
+                if column not in columns:
+                    conn.execute(f'ALTER TABLE birthdays ADD COLUMN "{column}" {column_type}')
+            #date is always stored as dd.mm.yyyy, see validate_date
+            conn.execute('''UPDATE birthdays SET
+                month=CAST(substr(date, 4, 2) AS integer),
+                day=CAST(substr(date, 1, 2) AS integer)
+                WHERE month IS NULL OR day IS NULL''')
+            conn.execute('UPDATE birthdays SET name_key=name_key(name) WHERE name_key IS NULL')
+            conn.execute('DROP INDEX IF EXISTS "birthdays_day_chat"')
+            conn.execute('CREATE INDEX IF NOT EXISTS "birthdays_month_day" ON birthdays (month, day)')
+            conn.execute('CREATE INDEX IF NOT EXISTS "birthdays_chat" ON birthdays (chat_id, month, day)')
+            conn.execute('CREATE INDEX IF NOT EXISTS "birthdays_chat_name" ON birthdays (chat_id, name)')
+            conn.execute('CREATE INDEX IF NOT EXISTS "birthdays_chat_name_key" ON birthdays (chat_id, name_key)')
+            conn.execute('''CREATE TABLE IF NOT EXISTS "chat_timezones" (
+            "chat_id"	long NOT NULL UNIQUE,
+            "tz"	text NOT NULL
+            );''')
+            conn.execute('DROP INDEX IF EXISTS "chat_timezones_tz"')
+            conn.execute('''CREATE TABLE IF NOT EXISTS "chat_celebrations" (
+            "chat_id"	long NOT NULL UNIQUE,
+            "date"	text NOT NULL
+            );''')
+
+    @timed('db_query_seconds', method='load_calendar')
+    def load_calendar(self, chat_filter : Callable[[int], bool] = None) -> None:
+        '''
+        Load birthdays to in-memory CalendarIndex with one streaming scan.
+        If chat_filter is set only chats it selects are loaded, e.g. chats of worker process,
+        lookups of other chats then find nothing.
+        '''
+        #calendar_index imports Birthday from this module
+        from calendar_index import CalendarIndex
+
+        rows = self.connection().execute(
+            'SELECT month, day, chat_id, CAST(substr(date, 7) AS integer), name FROM birthdays')
+        if chat_filter is not None:
+            rows = (i for i in rows if chat_filter(i[2]))
+        index = CalendarIndex()
+        index.load(rows)
+        self.calendar = index
 
     @staticmethod
     def validate_date(birth_date : str) -> str:
@@ -54,110 +329,393 @@ class Database:
         '''
         return name.strip()
 
+    @staticmethod
+    def name_key(name : str) -> str:
+        '''
+        Get case insensitive search key of name, unlike COLLATE NOCASE it folds not only ASCII letters.
+        '''
+        return name.strip().casefold()
+
+    @staticmethod
+    def validate_timezone(tz : str) -> str:
+        '''
+        Validate IANA timezone name, e.g. Europe/Kyiv.
+        '''
+        tz = tz.strip()
+        try:
+            ZoneInfo(tz)
+        except (ZoneInfoNotFoundError, ValueError):
+            raise ValueError(f'Unknown timezone {tz}')
+        return tz
+
+
+    def birthday_row(self, name : str, birth_date : str, chat_id : int) -> Tuple:
+        '''
+        Validate birthday and return row for INSERT_BIRTHDAY.
+        '''
+        name = self.validate_name(name)
+        birth_date = self.validate_date(birth_date)
+        d, m, _ = map(int, birth_date.split('.'))
+        return (f'{name}:{chat_id}', name, birth_date, chat_id, m, d, self.name_key(name))
 
+    @timed('db_query_seconds', method='add_birthday')
     def add_birthday(self, name : str, birth_date : str, chat_id : str):
         '''
         Add birthday to database.
         '''
-        name = self.validate_name(name)
-        values = (f'{name}:{chat_id}', name, self.validate_date(birth_date), chat_id)
+        values = self.birthday_row(name, birth_date, chat_id)
+        try:
+            self.submit(self._insert_birthday, values).result()
+            if self.calendar is not None:
+                self.calendar.add(Birthday.from_row(values[1:4]))
+        finally:
+            self.chat_cache.invalidate(chat_id)
+
+    @staticmethod
+    def _insert_birthday(conn : sqlite3.Connection, values : Tuple) -> None:
         try:
-            conn = sqlite3.connect(self.db_name)
-            c = conn.cursor()
-            c.execute('INSERT INTO birthdays VALUES (?,?,?,?)', values)
-            conn.commit()
+            conn.execute(INSERT_BIRTHDAY, values)
         except sqlite3.IntegrityError:
-            raise KeyError(f'Name {name} already exists!')
+            raise KeyError(f'Name {values[1]} already exists!')
+
+    @timed('db_query_seconds', method='add_birthdays')
+    def add_birthdays(self, birthdays : Iterable[Tuple[str, str, int]]) -> Tuple:
+        '''
+        Add many (name, birth_date, chat_id) birthdays in one transaction.
+        Wrong rows are skipped, return tuple of (row index, error) where error is
+        ValueError for malformed row, wrong name, date or chat_id and KeyError for existing name.
+        Exception given instead of row, e.g. by reader for unparsable line, is returned as its error.
+        '''
+        rows = []
+        errors = []
+        hashes = set()
+        for index, row in enumerate(birthdays):
+            if isinstance(row, Exception):
+                errors.append((index, row))
+                continue
+            try:
+                name, birth_date, chat_id = row
+            except (TypeError, ValueError):
+                errors.append((index, ValueError(f'Wrong row {row!r}')))
+                continue
+            if not isinstance(name, str):
+                errors.append((index, ValueError(f'Wrong name {name!r}')))
+                continue
+            try:
+                chat_id = int(chat_id)
+            except (TypeError, ValueError):
+                chat_id = None
+            #date is reported before chat_id, row without date has no chat_id either
+            try:
+                if not isinstance(birth_date, str):
+                    raise ValueError(birth_date)
+                values = self.birthday_row(name, birth_date, chat_id)
+            except ValueError:
+                errors.append((index, ValueError(f'Wrong date {birth_date!r}')))
+                continue
+            if chat_id is None:
+                errors.append((index, ValueError(f'Wrong chat_id {row[2]!r} for {name}')))
+                continue
+            if values[0] in hashes:
+                errors.append((index, KeyError(f'Name {values[1]} already exists!')))
+                continue
+            hashes.add(values[0])
+            rows.append((index, values))
+
+        try:
+            errors.extend(self.submit(self._insert_birthdays, rows).result())
+            if self.calendar is not None:
+                failed = {index for index, _ in errors}
+                for index, values in rows:
+                    if index not in failed:
+                        self.calendar.add(Birthday.from_row(values[1:4]))
+        finally:
+            for chat_id in {values[3] for _, values in rows}:
+                self.chat_cache.invalidate(chat_id)
+        return tuple(sorted(errors, key=lambda i: i[0]))
+
+    @staticmethod
+    def _insert_birthdays(conn : sqlite3.Connection, rows : List[Tuple]) -> List[Tuple]:
+        #writer holds write lock, so nobody inserts duplicates between check and insert
+        existing = set()
+        keys = [values[0] for _, values in rows]
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i+500]
+            query = 'SELECT hash FROM birthdays WHERE hash IN ({})'.format(','.join('?'*len(chunk)))
+            existing.update(h for h, in conn.execute(query, chunk))
+        #executemany failed in the middle would leave part of rows
+        conn.execute('SAVEPOINT add_birthdays')
+        try:
+            conn.executemany(INSERT_BIRTHDAY, (values for _, values in rows if values[0] not in existing))
+        except sqlite3.Error:
+            conn.execute('ROLLBACK TO add_birthdays')
+            raise
         finally:
-            conn.close()        
+            conn.execute('RELEASE add_birthdays')
+        return [(index, KeyError(f'Name {values[1]} already exists!')) for index, values in rows if values[0] in existing]
 
+    @timed('db_query_seconds', method='del_birthday')
     def del_birthday(self, name : str, chat_id : int):
         '''
         Delete birthday with specified name and chat_id from database. 
         '''
         name = self.validate_name(name)
         try:
-            conn = sqlite3.connect(self.db_name)
-            c = conn.cursor()
-            c.execute('DELETE FROM birthdays WHERE name=? AND chat_id=?', (name, chat_id) )
-            conn.commit()
+            self.submit(self._delete_birthday, name, chat_id).result()
+            if self.calendar is not None:
+                self.calendar.remove(name, chat_id)
+        finally:
+            self.chat_cache.invalidate(chat_id)
+
+    @staticmethod
+    def _delete_birthday(conn : sqlite3.Connection, name : str, chat_id : int) -> None:
+        try:
+            conn.execute('DELETE FROM birthdays WHERE name=? AND chat_id=?', (name, chat_id) )
         except sqlite3.IntegrityError:
             raise KeyError(f'No name {name} in chat {chat_id}!')
-        finally:
-            conn.close()
 
-    def get_chat_birthdays(self, chat_id : int) -> Tuple:
+    @timed('db_query_seconds', method='get_chat_birthdays')
+    def get_chat_birthdays(self, chat_id : int) -> Tuple[Birthday, ...]:
         '''
-        Get all birthdays from selected chat.
+        Get all birthdays from selected chat, recently used chats are served from cache.
         '''
-        b_list = tuple()
+        b_list = self.chat_cache.get(chat_id)
+        if b_list is not None:
+            return b_list
+        generation = self.chat_cache.generation
+        if self.calendar is not None:
+            b_list = self.calendar.chat(chat_id)
+            self.chat_cache.put(chat_id, b_list, generation)
+            return b_list
         try:
-            conn = sqlite3.connect(self.db_name)
-            c = conn.cursor()
-            b_list = c.execute('SELECT name, date, chat_id FROM birthdays WHERE chat_id=?', (chat_id,))
-            b_list = [dict(zip(BIRTHDAY_FIELDS, i)) for i in b_list]
+            c = self.connection().execute('SELECT name, date, chat_id FROM birthdays WHERE chat_id=?', (chat_id,))
+            b_list = tuple(map(Birthday.from_row, c))
         except sqlite3.IntegrityError:
             raise KeyError('No instances with this chat_id.')
-        finally:
-            conn.close()
-        
-        return tuple(b_list)
+        self.chat_cache.put(chat_id, b_list, generation)
+        return b_list
 
 
-    def get_all_birthdays(self) -> Tuple:
+    @timed('db_query_seconds', method='get_all_birthdays')
+    def get_all_birthdays(self) -> Tuple[Birthday, ...]:
         '''
         Get all birthdays from database.
         '''
-        b_list = tuple()
-        try:
-            conn = sqlite3.connect(self.db_name)
-            c = conn.cursor()
-            b_list = tuple(c.execute('SELECT name, date, chat_id FROM birthdays'))
-            b_list = [dict(zip(BIRTHDAY_FIELDS, i)) for i in b_list]
-        finally:
-            conn.close()
-        return tuple(b_list)
+        c = self.connection().execute('SELECT name, date, chat_id FROM birthdays')
+        return tuple(map(Birthday.from_row, c))
 
 
-    def get_birthdays_by_date(self, birth_date : str) -> Tuple:
+    def iter_all_birthdays(self, batch_size : int = 1000) -> Generator[Birthday, None, None]:
+        '''
+        Iterate over all birthdays, rows are fetched from database batch_size at a time.
+        Read transaction stays open until iteration ends.
+        '''
+        c = self.connection().execute('SELECT name, date, chat_id FROM birthdays')
+        while True:
+            rows = c.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from map(Birthday.from_row, rows)
+
+    @timed('db_query_seconds', method='get_birthdays_page')
+    def get_birthdays_page(self, after_rowid : int = 0, limit : int = 1000) -> Tuple[Tuple[Birthday, ...], Optional[int]]:
+        '''
+        Get up to limit birthdays with rowid greater than after_rowid.
+        Return page and after_rowid for next page, None if it was the last page.
+        '''
+        c = self.connection().execute(
+            'SELECT rowid, name, date, chat_id FROM birthdays WHERE rowid > ? ORDER BY rowid LIMIT ?',
+            (after_rowid, limit))
+        rows = c.fetchall()
+        page = tuple(Birthday.from_row(i[1:]) for i in rows)
+        return page, rows[-1][0] if len(rows) == limit else None
+
+    def iter_birthdays_pages(self, batch_size : int = 1000) -> Generator[Tuple[Birthday, ...], None, None]:
+        '''
+        Iterate over all birthdays page by page with keyset pagination.
+        Every page is separate short query, so long exports don't hold read transaction.
+        '''
+        after_rowid = 0
+        while after_rowid is not None:
+            page, after_rowid = self.get_birthdays_page(after_rowid, batch_size)
+            if page:
+                yield page
+
+    @timed('db_query_seconds', method='get_chat_names_page')
+    def get_chat_names_page(self, chat_id : int, after : str = None, before : str = None,
+                            limit : int = 8) -> Tuple[Tuple[str, ...], bool]:
+        '''
+        Get up to limit names of chat in alphabetical order after name after or before name before.
+        Return names and True if there are more names further in the same direction.
+        '''
+        if before is not None:
+            c = self.connection().execute(
+                'SELECT name FROM birthdays WHERE chat_id=? AND name<? ORDER BY name DESC LIMIT ?',
+                (chat_id, before, limit + 1))
+            names = [i for i, in c]
+            return tuple(reversed(names[:limit])), len(names) > limit
+        if after is None:
+            c = self.connection().execute(
+                'SELECT name FROM birthdays WHERE chat_id=? ORDER BY name LIMIT ?', (chat_id, limit + 1))
+        else:
+            c = self.connection().execute(
+                'SELECT name FROM birthdays WHERE chat_id=? AND name>? ORDER BY name LIMIT ?',
+                (chat_id, after, limit + 1))
+        names = [i for i, in c]
+        return tuple(names[:limit]), len(names) > limit
+
+    @timed('db_query_seconds', method='search_names')
+    def search_names(self, chat_id : int, prefix : str, limit : int = 8) -> Tuple[str, ...]:
+        '''
+        Get up to limit names of chat starting with prefix, case insensitive, in alphabetical order.
+        '''
+        key = self.name_key(prefix)
+        #range on name_key instead of LIKE, so the index is used for any prefix
+        c = self.connection().execute(
+            'SELECT name FROM birthdays WHERE chat_id=? AND name_key>=? AND name_key<? ORDER BY name_key LIMIT ?',
+            (chat_id, key, key + '\U0010ffff', limit))
+        return tuple(i for i, in c)
+
+    @timed('db_query_seconds', method='search_birthdays')
+    def search_birthdays(self, chat_id : int, prefix : str, limit : int = 8) -> Tuple[Birthday, ...]:
+        '''
+        Get up to limit birthdays of chat with names starting with prefix, like search_names.
+        '''
+        key = self.name_key(prefix)
+        c = self.connection().execute(
+            'SELECT name, date, chat_id FROM birthdays WHERE chat_id=? AND name_key>=? AND name_key<? ORDER BY name_key LIMIT ?',
+            (chat_id, key, key + '\U0010ffff', limit))
+        return tuple(map(Birthday.from_row, c))
+
+
+    @staticmethod
+    def days_left_map(today : datetime.date, days : int) -> Dict[Tuple[int, int], int]:
+        '''
+        Get (month, day) -> days left from today for every day of next days days.
+        Birthday on 29 February is celebrated on 28 February in non-leap years.
+        '''
+        result = {}
+        for i in range(min(days, 366) + 1):
+            date = today + datetime.timedelta(days=i)
+            result.setdefault((date.month, date.day), i)
+            if (date.month, date.day) == (2, 28) and not calendar.isleap(date.year):
+                result.setdefault((2, 29), i)
+        return result
+
+    @timed('db_query_seconds', method='get_upcoming')
+    def get_upcoming(self, chat_id : int, days : int = 7, today : datetime.date = None) -> Tuple[Tuple[Birthday, int], ...]:
+        '''
+        Get birthdays of chat in next days days with days left until them, nearest first.
+        Window is one or two (month, day) ranges on index, two if it wraps over new year.
+        '''
+        today = today or datetime.date.today()
+        days_left = self.days_left_map(today, days)
+        if self.calendar is not None:
+            result = [(i, days_left[(i.date.month, i.date.day)]) for i in self.calendar.chat_days(chat_id, days_left)]
+            result.sort(key=lambda i: (i[1], i[0].name))
+            return tuple(result)
+        if days >= 365:
+            ranges = [((1, 1), (12, 31))]
+        else:
+            last = today + datetime.timedelta(days=days)
+            start, end = (today.month, today.day), (last.month, last.day)
+            if end == (2, 28):
+                #29 February is celebrated on 28 February in non-leap years
+                end = (2, 29)
+            ranges = [(start, end)] if start <= end else [(start, (12, 31)), ((1, 1), end)]
+        rows = []
+        for start, end in ranges:
+            rows.extend(self.connection().execute(
+                'SELECT name, date, chat_id FROM birthdays WHERE chat_id=? AND (month, day)>=(?, ?) AND (month, day)<=(?, ?)',
+                (chat_id, *start, *end)))
+        result = []
+        for row in rows:
+            b_day = Birthday.from_row(row)
+            left = days_left.get((b_day.date.month, b_day.date.day))
+            if left is not None:
+                result.append((b_day, left))
+        result.sort(key=lambda i: (i[1], i[0].name))
+        return tuple(result)
+
+    @timed('db_query_seconds', method='get_chat_ids')
+    def get_chat_ids(self) -> Tuple[int, ...]:
+        '''
+        Get ids of all chats that have birthdays.
+        '''
+        return tuple(i for i, in self.connection().execute('SELECT DISTINCT chat_id FROM birthdays'))
+
+    @timed('db_query_seconds', method='get_birthdays_by_date')
+    def get_birthdays_by_date(self, birth_date : str) -> Tuple[Birthday, ...]:
         '''
         Select birthday with selected day and month from database.
         '''
         birth_date = self.validate_date(birth_date)
-        b_list = tuple()
-        d,m,_ = birth_date.split('.')
-        pattern = f'{d}\\.{m}\\.'
-        # print(f'SELECT * FROM birthdays WHERE date REGEXP "{pattern}"')
+        d, m, _ = map(int, birth_date.split('.'))
+        if self.calendar is not None:
+            return self.calendar.by_date(m, d)
+        c = self.connection().execute('SELECT name, date, chat_id FROM birthdays WHERE month=? AND day=?', (m, d))
+        return tuple(map(Birthday.from_row, c))
 
-        try:
-            conn = sqlite3.connect(self.db_name)
-            conn.create_function('regexp', 2, lambda x, y: 1 if re.search(x,y) else 0)
-            c = conn.cursor()
-            c.execute(f'SELECT name, date, chat_id FROM birthdays WHERE date REGEXP ?', (pattern,))
-            b_list = c.fetchall()
-            b_list = [dict(zip(BIRTHDAY_FIELDS, i)) for i in b_list]
-        finally:
-            conn.close()
-        return tuple(b_list)
+    @timed('db_query_seconds', method='set_timezone')
+    def set_timezone(self, chat_id : int, tz : Optional[str]):
+        '''
+        Set timezone of chat, None resets it to server timezone.
+        '''
+        if tz is None:
+            self.submit(lambda conn: conn.execute('DELETE FROM chat_timezones WHERE chat_id=?', (chat_id,))).result()
+        else:
+            tz = self.validate_timezone(tz)
+            self.submit(lambda conn: conn.execute('INSERT OR REPLACE INTO chat_timezones (chat_id, tz) VALUES (?,?)',
+                (chat_id, tz))).result()
 
+    @timed('db_query_seconds', method='get_timezone')
+    def get_timezone(self, chat_id : int) -> Optional[str]:
+        '''
+        Get timezone of chat, None if it is not set.
+        '''
+        row = self.connection().execute('SELECT tz FROM chat_timezones WHERE chat_id=?', (chat_id,)).fetchone()
+        return row[0] if row else None
 
-    def get_birthday(self, name : str, chat_id : int) -> Tuple:
+    @timed('db_query_seconds', method='get_timezones')
+    def get_timezones(self) -> Dict[int, str]:
         '''
-        Get birthday with selected name and selected chat_id
+        Get timezones of all chats that have it set.
+        '''
+        return dict(self.connection().execute('SELECT chat_id, tz FROM chat_timezones'))
+
+    @timed('db_query_seconds', method='set_celebrated')
+    def set_celebrated(self, dates : Dict[int, datetime.date]):
+        '''
+        Save chat_id -> local date when chat was celebrated.
+        '''
+        rows = [(chat_id, date.isoformat()) for chat_id, date in dates.items()]
+        if rows:
+            self.submit(lambda conn: conn.executemany(
+                'INSERT OR REPLACE INTO chat_celebrations (chat_id, date) VALUES (?,?)', rows)).result()
+
+    @timed('db_query_seconds', method='get_celebrated')
+    def get_celebrated(self, since : datetime.date) -> Dict[int, datetime.date]:
+        '''
+        Get chat_id -> local date of last celebration for chats celebrated since selected date.
+        '''
+        c = self.connection().execute('SELECT chat_id, date FROM chat_celebrations WHERE date>=?', (since.isoformat(),))
+        return {chat_id: datetime.date.fromisoformat(date) for chat_id, date in c}
+
+
+    @timed('db_query_seconds', method='get_birthday')
+    def get_birthday(self, name : str, chat_id : int) -> Optional[Birthday]:
+        '''
+        Get birthday with selected name and selected chat_id, None if there is no such birthday.
         '''
         name = self.validate_name(name)
-        try:
-            conn = sqlite3.connect(self.db_name)
-            c = conn.cursor()
-            c.execute('SELECT name, date, chat_id FROM birthdays WHERE name=? AND chat_id=?', (name, chat_id) )
-            b_day = c.fetchone()
-            if b_day:
-                b_day = dict(zip(BIRTHDAY_FIELDS, b_day))
-            else: 
-                b_day = dict()
-        finally:
-            conn.close()
-        return b_day
+        b_list = self.chat_cache.get(chat_id)
+        if b_list is None and self.calendar is not None:
+            b_list = self.get_chat_birthdays(chat_id)
+        if b_list is not None:
+            return next((i for i in b_list if i.name == name), None)
+        c = self.connection().execute('SELECT name, date, chat_id FROM birthdays WHERE name=? AND chat_id=?', (name, chat_id) )
+        b_day = c.fetchone()
+        return Birthday.from_row(b_day) if b_day else None
 
 
 
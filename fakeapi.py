@@ -0,0 +1,188 @@
+'''
+This module implements local stub of telegram bot API, it uses to measure bot without network.
+
+Classes:
+    FakeTelegramAPI : threaded http server that answers like telegram bot API
+'''
+
+from typing import Dict, List
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+import json
+import threading
+import time
+
+
+class _TooManyRequests(Exception):
+    '''
+    Raised by fake API methods to answer with 429.
+    '''
+    def __init__(self, retry_after : float):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    '''
+    Http handler that passes bot API calls to FakeTelegramAPI.
+    '''
+    #keep-alive, so pooled clients reuse connections
+    protocol_version = 'HTTP/1.1'
+    #headers and body are written separately, without it keep-alive hits delayed ack
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        if body:
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                params.update(json.loads(body))
+            else:
+                params.update(parse_qsl(body.decode()))
+        method = url.path.rsplit('/', 1)[-1]
+        status, result = self.server.api.call(method, params)
+        data = json.dumps(result).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+class FakeTelegramAPI:
+    '''
+    Stub of telegram bot API. Supports getUpdates, sendMessage, editMessageText
+    and accepts setWebhook and deleteWebhook.
+    Updates are added with push_update, sent and edited messages are stored in sent.
+    '''
+
+    def __init__(self, host : str = '127.0.0.1', port : int = 0, latency : float = 0.0,
+                 chat_interval : float = 0.0):
+        '''
+        FakeTelegramAPI constructor.
+        latency is delay in seconds added to every answer.
+        If chat_interval is set, messages sent to one chat more often get 429 answer.
+        '''
+        self.latency = latency
+        self.chat_interval = chat_interval
+        self.too_many_requests = 0
+        self.sent = []
+        self.webhook = None
+        self._chat_sent = {}
+        self._updates = []
+        self._update_id = 0
+        self._message_id = 0
+        self._cond = threading.Condition()
+        self._server = ThreadingHTTPServer((host, port), _RequestHandler)
+        self._server.daemon_threads = True
+        self._server.api = self
+        self._thread = None
+
+    @property
+    def server_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'FakeTelegramAPI':
+        '''
+        Start serving in background thread.
+        '''
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        '''
+        Stop server.
+        '''
+        self._server.shutdown()
+        self._server.server_close()
+
+    def push_update(self, update : Dict) -> int:
+        '''
+        Add update for getUpdates, update_id is set if missing. Return update_id.
+        '''
+        with self._cond:
+            self._update_id += 1
+            update = dict(update)
+            update.setdefault('update_id', self._update_id)
+            self._updates.append(update)
+            self._cond.notify_all()
+        return update['update_id']
+
+    def push_message(self, chat_id : int, text : str) -> int:
+        '''
+        Add update with text message from chat.
+        '''
+        message = {
+            'message_id': self._next_message_id(),
+            'chat': {'id': chat_id, 'first_name': 'chat'},
+            'from': {'first_name': 'first', 'last_name': 'last'},
+            'text': text,
+            }
+        return self.push_update({'message': message})
+
+    def _next_message_id(self) -> int:
+        with self._cond:
+            self._message_id += 1
+            return self._message_id
+
+    def call(self, method : str, params : Dict):
+        '''
+        Process bot API method call, return http status and answer json.
+        '''
+        if self.latency:
+            time.sleep(self.latency)
+        handler = getattr(self, f'_api_{method}', None)
+        if handler is None:
+            return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+        try:
+            return 200, {'ok': True, 'result': handler(params)}
+        except _TooManyRequests as e:
+            return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                         'parameters': {'retry_after': e.retry_after}}
+
+    def _api_getUpdates(self, params : Dict) -> List:
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        limit = int(params.get('limit') or 100)
+        with self._cond:
+            self._updates = [i for i in self._updates if i['update_id'] >= offset]
+            if not self._updates and timeout:
+                self._cond.wait(timeout)
+            return self._updates[:limit]
+
+    def _api_sendMessage(self, params : Dict) -> Dict:
+        if self.chat_interval:
+            now = time.monotonic()
+            with self._cond:
+                last = self._chat_sent.get(params['chat_id'], -self.chat_interval)
+                if now - last < self.chat_interval:
+                    self.too_many_requests += 1
+                    raise _TooManyRequests(self.chat_interval)
+                self._chat_sent[params['chat_id']] = now
+        message = {'message_id': self._next_message_id(), 'chat': {'id': int(params['chat_id'])},
+                   'text': params.get('text', '')}
+        self.sent.append(('sendMessage', params))
+        return message
+
+    def _api_editMessageText(self, params : Dict) -> Dict:
+        self.sent.append(('editMessageText', params))
+        return {'message_id': int(params['message_id']), 'chat': {'id': int(params['chat_id'])},
+                'text': params.get('text', '')}
+
+    def _api_setWebhook(self, params : Dict) -> bool:
+        self.webhook = params
+        return True
+
+    def _api_deleteWebhook(self, params : Dict) -> bool:
+        self.webhook = None
+        return True
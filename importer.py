@@ -0,0 +1,129 @@
+'''
+This module implements bulk import of birthdays from CSV, JSON or JSON Lines file.
+
+Usage:
+    python importer.py FILE [--db data.db] [--chat-id CHAT_ID] [--batch-size 1000]
+
+Format is chosen by file extension: .jsonl is JSON Lines with one row object per line,
+.json is one JSON array of row objects, anything else is CSV.
+CSV rows are "name,day.month.year[,chat_id]", JSON rows are
+{"name": ..., "birth_date": ..., "chat_id": ...}. chat_id of row may be omitted or empty if --chat-id is set.
+
+Functions:
+    read_csv : read birthdays from CSV file
+    read_json : read birthdays from JSON array file
+    read_jsonl : read birthdays from JSON Lines file
+    import_birthdays : write birthdays to database in batches
+'''
+
+from typing import Generator, Iterable, TextIO, Tuple
+from itertools import islice
+import argparse
+import csv
+import json
+
+from database import Database
+
+
+def read_csv(file : TextIO, chat_id : int = None) -> Generator[Tuple, None, None]:
+    '''
+    Read (name, birth_date, chat_id) rows from CSV file.
+    '''
+    for row in csv.reader(file):
+        if not row or row[0].startswith('#'):
+            continue
+        name, birth_date = row[0], row[1].strip() if len(row) > 1 else ''
+        row_chat_id = row[2].strip() if len(row) > 2 else ''
+        yield name, birth_date, row_chat_id or chat_id
+
+
+def _json_row(row, chat_id : int = None):
+    '''
+    Get (name, birth_date, chat_id) row from parsed JSON object, ValueError if it is not an object.
+    '''
+    if not isinstance(row, dict):
+        return ValueError(f'Wrong row {row!r}')
+    row_chat_id = row.get('chat_id')
+    return row.get('name', ''), row.get('birth_date', ''), chat_id if row_chat_id in (None, '') else row_chat_id
+
+
+def read_json(file : TextIO, chat_id : int = None) -> Generator[Tuple, None, None]:
+    '''
+    Read (name, birth_date, chat_id) rows from file with JSON array of row objects.
+    Whole file is parsed at once, unparsable file gives single ValueError instead of rows.
+    '''
+    try:
+        rows = json.load(file)
+    except ValueError as e:
+        yield ValueError(f'Wrong json: {e}')
+        return
+    if not isinstance(rows, list):
+        yield ValueError('Wrong json: array of rows expected')
+        return
+    for row in rows:
+        yield _json_row(row, chat_id)
+
+
+def read_jsonl(file : TextIO, chat_id : int = None) -> Generator[Tuple, None, None]:
+    '''
+    Read (name, birth_date, chat_id) rows from JSON Lines file.
+    Unparsable line gives ValueError instead of row, so it is reported as error of its row.
+    '''
+    for line in file:
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield ValueError(f'Wrong json: {e}')
+            continue
+        yield _json_row(row, chat_id)
+
+
+def import_birthdays(db : Database, birthdays : Iterable[Tuple], batch_size : int = 1000) -> Tuple[int, Tuple]:
+    '''
+    Add birthdays to database, one transaction per batch_size rows.
+    Return number of added rows and tuple of (row index, error).
+    '''
+    birthdays = iter(birthdays)
+    added = 0
+    errors = []
+    start = 0
+    while True:
+        batch = list(islice(birthdays, batch_size))
+        if not batch:
+            break
+        batch_errors = db.add_birthdays(batch)
+        errors.extend((start + index, error) for index, error in batch_errors)
+        added += len(batch) - len(batch_errors)
+        start += len(batch)
+    return added, tuple(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import birthdays from CSV, JSON or JSON Lines file.')
+    parser.add_argument('file')
+    parser.add_argument('--db', default='data.db')
+    parser.add_argument('--chat-id', type=int, default=None)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.file.endswith('.jsonl'):
+        reader = read_jsonl
+    elif args.file.endswith('.json'):
+        reader = read_json
+    else:
+        reader = read_csv
+    db = Database(args.db)
+    try:
+        with open(args.file, 'r', encoding='utf-8', newline='') as f:
+            added, errors = import_birthdays(db, reader(f, args.chat_id), args.batch_size)
+    finally:
+        db.close()
+    for index, error in errors:
+        print(f'row {index + 1}: {error}')
+    print(f'Added {added} birthdays, {len(errors)} errors.')
+
+
+if __name__ == '__main__':
+    main()
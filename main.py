@@ -1,12 +1,18 @@
 
-from tbot import BotHandler, Message, Callback, InlineButton
+from tbot import BotHandler, Message, Callback, InlineButton, PagedKeyboard, split_message
 import re
 import datetime
-from database import Database
+from database import Database, Birthday
+from offsets import OffsetStore
+from sender import SendQueue
+from scheduler import BirthdayScheduler, WeeklyJob, next_occurrence
 import json
 import time
 import requests
+import argparse
+import signal
 import os
+import metrics
 
 token = None
 try:
@@ -14,55 +20,82 @@ try:
         token = f.read().strip()
 except FileNotFoundError:
     token = os.environ.get('TOKEN')
-my_bot = BotHandler(token)
-db = Database('data.db')
+db_name = os.environ.get('DB_NAME', 'data.db')
+#offset survives restarts, so handled updates are not handled again, empty OFFSET_FILE disables it
+#webhook delivers updates one by one, so repeats are merged within COALESCE_WINDOW seconds, not only in batch
+my_bot = BotHandler(token, server=os.environ.get('TELEGRAM_API', 'https://api.telegram.org'),
+                    bot_name=os.environ.get('BOT_NAME'),
+                    offset_store=OffsetStore(os.environ.get('OFFSET_FILE', f'{db_name}.offset')),
+                    coalesce_window=float(os.environ.get('COALESCE_WINDOW', 1 if os.environ.get('WEBHOOK_URL') else 0)))
+db = Database(db_name)
+send_queue = SendQueue(my_bot)
 
 
 class BirthdayHandler:
     '''
-    BirthdayHandler class implement functions to find today's birthdays and celebrate.
+    BirthdayHandler class implement functions to celebrate birthdays.
     '''
 
-    def __init__(self):
+    def celebrate_due(self, b_list):
         '''
-        BirthdayHandler constructor
+        Celebrate birthdays that scheduler found due, one greeting per chat.
+        Local date of celebration is saved, so restart doesn't celebrate chat again the same day.
         '''
-        self._prev_date = None
-
-    def check_birthday(self):
+        chats = {}
+        for i in b_list:
+            chats.setdefault(i.chat_id, []).append(i)
+        for chat_id, chat_list in chats.items():
+            self.celebrate(chat_id, chat_list)
+        db.set_celebrated({chat_id: scheduler.local_date(chat_id) for chat_id in chats})
+
+    @staticmethod
+    def greetings(b_list):
         '''
-        Check there are birthdays today.
+        Render greeting for birthdays of one chat, split into messages that fit telegram limit.
         '''
-        cur_date = datetime.date.today()
-        if self._prev_date != cur_date:
-            self._prev_date = cur_date
-            b_list = db.get_birthdays_by_date(cur_date.strftime('%d.%m.%Y'))
-            for i in b_list:
-                self.celebrate(name=i['name'],birth_date=i['birth_date'],chat_id=i['chat_id'])
-            
-
-    def celebrate(self, name, birth_date, chat_id):
+        if len(b_list) == 1:
+            return [f'С днем рождения {b_list[0].name}! 🎂😘']
+        return split_message([f' {i.name}' for i in b_list], 'С днем рождения🎂😘')
+
+    def celebrate(self, chat_id, b_list):
         '''
-        Celebrates the birthday.
+        Celebrates birthdays of chat, override it to change how chat is greeted.
         '''
-        my_bot.send_message(chat_id, f'С днем рождения {name}! 🎂😘')
+        for text in self.greetings(b_list):
+            send_queue.send_message(chat_id, text)
 
 
     def check_new_birthday(self, name, birth_date, chat_id):
         '''
-        Check if selected birthday is tooday.
+        Check if selected birthday is tooday and schedule its next celebrations.
+        '''
+        self.check_new_birthdays([(name, birth_date, chat_id)])
+
+    def check_new_birthdays(self, birthdays):
+        '''
+        Check which of new (name, birth_date, chat_id) birthdays are today,
+        celebrate them with one greeting per chat and schedule next celebrations.
         '''
-        c_date = datetime.date.today()
-        d,m,_ = map(int, birth_date.split('.'))
-        if d == c_date.day and m == c_date.month:
-            self.celebrate(name, birth_date, chat_id)
+        today = []
+        for name, birth_date, chat_id in birthdays:
+            d,m,y = map(int, birth_date.split('.'))
+            b_day = Birthday(db.validate_name(name), datetime.date(y,m,d), chat_id)
+            c_date = scheduler.local_date(chat_id)
+            if next_occurrence(b_day.date, c_date) == c_date:
+                today.append(b_day)
+            scheduler.add(b_day, skip_today=True)
+        if today:
+            self.celebrate_due(today)
         
 
 birthday_handler = BirthdayHandler()
+#chat_id -> timezone, loaded in main() and changed by /tz
+timezones = {}
+scheduler = BirthdayScheduler(birthday_handler.celebrate_due, timezone_of=timezones.get)
 
 
 
-@my_bot.recieve_command_decorator('/help')
+@my_bot.recieve_command_decorator('/help', coalesce=True)
 def help_command(message : Message):
     '''
     Recieve /help command and send help information to chat.
@@ -79,18 +112,27 @@ def help_command(message : Message):
     Показывает данное сообщение с описанием бота.
     /add [имя] [день].[месяц].[год]
     Добавляет новый День Рождения Пример "/add test 1.1.1111"
-    /del 
+    /import
+    Добавляет много Дней Рождения, каждый с новой строки в формате [имя] [день].[месяц].[год]
+    /del [начало имени]
     Показывает список для выбора какой День Рождение нужно удалить.
+    /find [начало имени]
+    Ищет Дни Рождения по началу имени, например "/find вас"
     /list
     Показывает все Дни Рождения.
-    /calc 
+    /tz [часовой пояс]
+    Устанавливает часовой пояс чата, например "/tz Europe/Kyiv". Без аргумента показывает текущий.
+    /calc [начало имени]
     Подсчитывает сколько осталось дней до выбранного Дня Рождения.
+    /upcoming [дней]
+    Показывает Дни Рождения в ближайшие дни, по умолчанию 7.
 
     Исходники 😍 лежат тут: https://github.com/yarik2215/birthdaybot/tree/dev_callback
     """
     my_bot.send_message(message.chat_id, help_str)
 
 
+#greets sender, so /start of different users is not merged
 @my_bot.recieve_command_decorator('/start')
 def hello_message(message : Message) -> None:
     '''
@@ -123,15 +165,74 @@ def add_command(message : Message):
     # print(match)
 
 
+@my_bot.recieve_command_decorator('/import')
+def import_command(message : Message):
+    '''
+    Recieve /import command with "[name] [day].[month].[year]" on every next line, add all birthdays.
+    '''
+    birthdays = []
+    lines = []
+    errors = []
+    for n, line in enumerate(message.text.split('\n')[1:], 1):
+        match = re.search(r'(.*) (\d{1,2}\.\d{1,2}\.\d{1,4})', line.strip())
+        if match:
+            birthdays.append((*match.groups(), message.chat_id))
+            lines.append(n)
+        elif line.strip():
+            errors.append((n, 'неправильный формат'))
+    b_errors = db.add_birthdays(birthdays)
+    for index, error in b_errors:
+        errors.append((lines[index], 'такое имя уже есть' if isinstance(error, KeyError) else 'неправильная дата'))
+    failed = {index for index, _ in b_errors}
+    added = [i for index, i in enumerate(birthdays) if index not in failed]
+    text = f'Добавлено дней рождения😃: {len(added)}'
+    if errors:
+        text += '\n' + '\n'.join(f'Строка {n}: {error}' for n, error in sorted(errors))
+    my_bot.send_message(message.chat_id, text)
+    birthday_handler.check_new_birthdays(added)
+
+
+def send_keyboard(keyboard : PagedKeyboard, message : Message):
+    '''
+    Send keyboard with all names of chat or with names starting with command argument.
+    '''
+    args = message.text.split(maxsplit=1)[1:]
+    if not args:
+        keyboard.send(message.chat_id)
+        return
+    names = db.search_names(message.chat_id, args[0], keyboard.page_size)
+    if not names:
+        my_bot.send_message(message.chat_id, 'Никого не найдено🤷')
+        return
+    keyboard.send(message.chat_id, names)
+
+
+@my_bot.recieve_command_decorator('/find', coalesce=True)
+def find_command(message : Message):
+    '''
+    Recieve /find command and send birthdays with names starting with prefix.
+    '''
+    args = message.text.split(maxsplit=1)[1:]
+    if not args:
+        my_bot.send_message(message.chat_id, 'Напиши начало имени, например "/find вас"')
+        return
+    b_list = db.search_birthdays(message.chat_id, args[0], 20)
+    if not b_list:
+        my_bot.send_message(message.chat_id, 'Никого не найдено🤷')
+        return
+    formated_list = '\n'.join(f' {i.name} {i.birth_date}' for i in b_list)
+    my_bot.send_message(message.chat_id, f'Найдено🔎:\n{formated_list}')
+
+
+del_keyboard = PagedKeyboard(my_bot, 'del', 'Кого удалить?', db.get_chat_names_page,
+                             header=[[InlineButton('Cancel','Cancel','cancel')]])
+
 @my_bot.recieve_command_decorator('/del')
 def del_command(message : Message):
     '''
-    Get /del command and delete birthday with specified name
+    Get /del command and delete birthday with specified name, /del prefix shows only names starting with prefix.
     '''
-    names = db.get_chat_birthdays(message.chat_id)
-    b_list = [[InlineButton('Cancel','Cancel','cancel')]]
-    b_list.extend([[InlineButton(text = i['name'], data = i['name'], handler_name = 'del')] for i in names])
-    my_bot.send_inline_keyboard(message.chat_id,'Кого удалить?',b_list)
+    send_keyboard(del_keyboard, message)
 
 @my_bot.recieve_callback_decorator('del')
 def del_callback(callback : Callback):
@@ -142,13 +243,14 @@ def del_callback(callback : Callback):
     try:
         name = callback.data
         db.del_birthday(name, callback.chat_id)
+        scheduler.remove(db.validate_name(name), callback.chat_id)
         text = f'{name} удален.'
     except KeyError:
         text = 'Упс, какая-то ошибочка)'
     my_bot.edit_message(callback.chat_id, callback.message.message_id, text)
 
 
-@my_bot.recieve_callback_decorator('cancel')
+@my_bot.recieve_callback_decorator('cancel', coalesce=True)
 def del_cancel_callback(callback : Callback):
     '''
     Cancel inline button selected callback handler.
@@ -156,7 +258,7 @@ def del_cancel_callback(callback : Callback):
     my_bot.edit_message(callback.chat_id, callback.message.message_id, 'Ну и ладно.😒')
 
 
-@my_bot.recieve_command_decorator('/list')
+@my_bot.recieve_command_decorator('/list', coalesce=True)
 def list_command(message : Message):
     '''
     Get /list command and send all birthdays specified for this chat to chat.
@@ -167,45 +269,109 @@ def list_command(message : Message):
     my_bot.send_message(message.chat_id, f'Дни рождения🎂:\n{formated_list}')
 
 
-def calc_days(birth_date : datetime.date):
+@my_bot.recieve_command_decorator('/tz')
+def timezone_command(message : Message):
+    '''
+    Recieve /tz command, set timezone of chat or show current one.
+    '''
+    args = message.text.split(maxsplit=1)[1:]
+    if not args:
+        tz = timezones.get(message.chat_id)
+        my_bot.send_message(message.chat_id, f'Часовой пояс: {tz or "серверный"}')
+        return
+    try:
+        tz = db.validate_timezone(args[0])
+    except ValueError:
+        my_bot.send_message(message.chat_id, 'Упс, неизвестный часовой пояс. Пример: /tz Europe/Kyiv')
+        return
+    db.set_timezone(message.chat_id, tz)
+    old_tz = timezones.get(message.chat_id)
+    timezones[message.chat_id] = tz
+    scheduler.reschedule_chat(db.get_chat_birthdays(message.chat_id), old_tz)
+    my_bot.send_message(message.chat_id, f'Часовой пояс установлен: {tz}')
+
+
+def calc_days(birth_date : datetime.date, now_date : datetime.date = None):
     '''
     Calculates how many days left until this date not included year
     '''
-    d = birth_date.day
-    m = birth_date.month
-    now_date = datetime.date.today()
-    b_date = datetime.date(day=d,month=m,year=now_date.year)
-    if now_date > b_date:
-        b_date = datetime.date(day=d,month=m,year=now_date.year+1)
-    calc_date = b_date - now_date
+    now_date = now_date or datetime.date.today()
+    calc_date = next_occurrence(birth_date, now_date) - now_date
     return calc_date.days
 
+calc_keyboard = PagedKeyboard(my_bot, 'calc', 'Сколько дней осталось до дня рождения', db.get_chat_names_page,
+                              header=[[InlineButton('Cancel','Cancel','cancel')]])
+
 @my_bot.recieve_command_decorator('/calc')
 def calculate_command(message : Message):
     '''
-    Calculate how much days left for birthday
+    Calculate how much days left for birthday, /calc prefix shows only names starting with prefix.
     '''
-    names = db.get_chat_birthdays(message.chat_id)
-    b_list = [[InlineButton('Cancel','Cancel','cancel')]]
-    b_list.extend([[InlineButton(text = i['name'], data = i['name'], handler_name = 'calc')] for i in names])
-    my_bot.send_inline_keyboard(message.chat_id, 'Сколько дней осталось до дня рождения', b_list)
+    send_keyboard(calc_keyboard, message)
     
-@my_bot.recieve_callback_decorator('calc')
+@my_bot.recieve_callback_decorator('calc', coalesce=True)
 def calc_callback(callback : Callback):    
     '''
     Calculate callback, send how much days left until selected birthday.
     '''
     _name = callback.data
-    try:
-        b_dict = db.get_birthday(_name, callback.chat_id)
-    except KeyError:
+    b_day = db.get_birthday(_name, callback.chat_id)
+    if not b_day:
         my_bot.send_message(callback.chat_id, 'Упс ошибочка')
         return
-    d,m,y = map(int, b_dict['birth_date'].split('.'))
-    days = calc_days(datetime.date(y,m,d))
+    days = calc_days(b_day.date, scheduler.local_date(callback.chat_id))
     my_bot.edit_message(callback.chat_id, callback.message.message_id, f'Осталось {days} дней до дня рождения "{_name}"')
     
 
+def format_upcoming(upcoming):
+    '''
+    Format (birthday, days left) pairs from Database.get_upcoming as lines.
+    '''
+    lines = []
+    for b_day, days in upcoming:
+        when = 'сегодня🎂' if days == 0 else f'через {days} дн.'
+        lines.append(f' {b_day.name} {b_day.date:%d.%m} — {when}')
+    return lines
+
+
+@my_bot.recieve_command_decorator('/upcoming', coalesce=True)
+def upcoming_command(message : Message):
+    '''
+    Recieve /upcoming [days] command and send birthdays of next days, 7 by default.
+    '''
+    args = message.text.split(maxsplit=1)[1:]
+    try:
+        days = min(max(int(args[0]), 0), 366) if args else 7
+    except ValueError:
+        my_bot.send_message(message.chat_id, 'Упс, нужно число дней. Пример: /upcoming 30')
+        return
+    upcoming = db.get_upcoming(message.chat_id, days, scheduler.local_date(message.chat_id))
+    if not upcoming:
+        my_bot.send_message(message.chat_id, f'В ближайшие {days} дн. дней рождения нет')
+        return
+    #long window of big chat doesn't fit one message
+    for text in split_message(format_upcoming(upcoming), 'Ближайшие дни рождения🎉:'):
+        my_bot.send_message(message.chat_id, text)
+
+
+def send_digest(days : int = 7):
+    '''
+    Send birthdays of next days to every chat of this process, split into messages that fit telegram limit.
+    '''
+    for chat_id in db.get_chat_ids():
+        if chat_filter is not None and not chat_filter(chat_id):
+            continue
+        upcoming = db.get_upcoming(chat_id, days, scheduler.local_date(chat_id))
+        if upcoming:
+            for text in split_message(format_upcoming(upcoming), 'Дни рождения на этой неделе🎉:'):
+                send_queue.send_message(chat_id, text)
+
+#selects chats of this process in supervisor mode, set in start_services
+chat_filter = None
+#weekly digest is sent if DIGEST_WEEKDAY is set, 0 is Monday
+digest_job = WeeklyJob(send_digest, int(os.environ.get('DIGEST_WEEKDAY') or 0), int(os.environ.get('DIGEST_HOUR', 9)))
+
+
 @my_bot.recieve_command_decorator('/test')
 def test_markup_command(message : Message):
     '''
@@ -219,7 +385,7 @@ def test_markup_command(message : Message):
     my_bot.send_inline_keyboard(message.chat_id, 'Test', buttons)
 
 
-@my_bot.recieve_callback_decorator('test')
+@my_bot.recieve_callback_decorator('test', coalesce=True)
 def test_callback(callback : Callback):
     '''
     /test Inline keyboard callback, edit message with inline keyboard depends on your answer
@@ -228,18 +394,84 @@ def test_callback(callback : Callback):
 
 
 
+def start_services(shard = None, rate_share : float = 1):
+    '''
+    Start sending queue and birthday scheduler.
+    shard is function chat_id -> bool that selects chats of this process,
+    rate_share is part of telegram global messages limit that this process can use.
+    '''
+    global chat_filter
+    chat_filter = shard
+    send_queue.set_global_rate(30*rate_share)
+    send_queue.start()
+    timezones.update(db.get_timezones())
+    #CALENDAR_INDEX=1 serves day and chat lookups from memory, worker loads only its chats,
+    #they are written only by this process, so index stays in sync
+    if os.environ.get('CALENDAR_INDEX'):
+        db.load_calendar(shard)
+    b_list = db.iter_all_birthdays()
+    if shard is not None:
+        b_list = (i for i in b_list if shard(i.chat_id))
+    #local date of any timezone is not earlier than yesterday of server
+    celebrated = db.get_celebrated(datetime.date.today() - datetime.timedelta(days=1))
+    scheduler.load(b_list, celebrated=celebrated)
+    scheduler.start()
+    if os.environ.get('DIGEST_WEEKDAY'):
+        digest_job.start()
+
+
+def stop_services():
+    '''
+    Stop scheduler, send messages in flight and close database.
+    '''
+    digest_job.stop(timeout=10)
+    scheduler.stop(timeout=10)
+    send_queue.stop(timeout=10)
+    my_bot.close()
+    db.close()
+
+
+def handle_sigterm(signum, frame):
+    '''
+    Stop bot on SIGTERM like on Ctrl+C, heroku sends it on restart.
+    '''
+    my_bot.stop()
+    raise KeyboardInterrupt
+
+
 def main():  
+    parser = argparse.ArgumentParser(description='Birthday bot.')
+    parser.add_argument('-p', '--port', type=int, default=None, help='port for webhook server')
+    args = parser.parse_args()
+    #webhook mode needs public url, e.g. https://app.herokuapp.com/webhook
+    webhook_url = os.environ.get('WEBHOOK_URL')
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    #webhook server also answers /metrics on its own port
+    if os.environ.get('METRICS_PORT'):
+        metrics.start_http_server(int(os.environ['METRICS_PORT']))
+    if os.environ.get('METRICS_LOG_INTERVAL'):
+        metrics.start_log_dump(float(os.environ['METRICS_LOG_INTERVAL']))
+
     print('Bot started!')
+    start_services()
     try:
-        while True:
-            birthday_handler.check_birthday()
+        if webhook_url and args.port:
+            try:
+                my_bot.run_webhook(webhook_url, args.port, secret_token=os.environ.get('WEBHOOK_SECRET'))
+            except (ConnectionError, requests.exceptions.RequestException) as e:
+                print(f'Webhook failed, fall back to polling: {e}')
+            else:
+                return
+        if webhook_url:
+            #telegram doesn't answer getUpdates while webhook is set
             try:
-                my_bot.polling()
-            except requests.exceptions.ConnectionError:
-                time.sleep(5*60)
+                my_bot.delete_webhook()
+            except requests.exceptions.RequestException as e:
+                print(f'deleteWebhook failed: {e}')
+        my_bot.run_polling()
     finally:
-        #add my_bot.stop()
-        pass    
+        my_bot.stop()
+        stop_services()
 
 
 if __name__ == '__main__':  
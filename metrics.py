@@ -0,0 +1,236 @@
+'''
+This module implements lightweight metrics with Prometheus text exposition.
+Metrics live in process wide REGISTRY, timing costs about a microsecond, so it stays on in production.
+
+Classes:
+    Counter : monotonically increasing value
+    Histogram : distribution of observed values in fixed buckets
+    Registry : named metrics with labels
+
+Functions:
+    counter : get counter from REGISTRY
+    histogram : get histogram from REGISTRY
+    timed : decorator that observes call duration into histogram of REGISTRY
+    exposition : REGISTRY in Prometheus text format as (content type, body)
+    start_http_server : serve /metrics in background thread
+    start_log_dump : print metrics summary periodically
+'''
+
+from typing import Dict, Tuple
+from bisect import bisect_left
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+
+#seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Counter:
+    '''
+    Monotonically increasing value.
+    '''
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount : float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class Histogram:
+    '''
+    Count of observed values in buckets with upper bounds, plus their sum and count.
+    '''
+    __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, buckets : Tuple = BUCKETS):
+        self.buckets = tuple(buckets)
+        #last one is +Inf bucket
+        self.counts = [0]*(len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value : float) -> None:
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Registry:
+    '''
+    Metrics by name and labels.
+    '''
+
+    def __init__(self):
+        #(name, labels) -> metric
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name : str, labels : Dict, *args):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(key, cls(*args))
+        if not isinstance(metric, cls):
+            raise TypeError(f'Metric {name} is not {cls.__name__}')
+        return metric
+
+    def counter(self, name : str, **labels) -> Counter:
+        '''
+        Get counter, create it on first call.
+        '''
+        return self._get(Counter, name, labels)
+
+    def histogram(self, name : str, buckets : Tuple = BUCKETS, **labels) -> Histogram:
+        '''
+        Get histogram, create it on first call.
+        '''
+        return self._get(Histogram, name, labels, buckets)
+
+    def timed(self, name : str, **labels):
+        '''
+        Decorator that observes duration of every call in seconds to histogram name,
+        and counts exceptions in errors_total counter with the same labels.
+        '''
+        hist = self.histogram(name, **labels)
+        errors = self.counter('errors_total', metric=name, **labels)
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    errors.inc()
+                    raise
+                finally:
+                    hist.observe(time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def _labels(labels : Tuple, extra : str = '') -> str:
+        items = [f'{k}="{_escape(v)}"' for k, v in labels]
+        if extra:
+            items.append(extra)
+        return '{' + ','.join(items) + '}' if items else ''
+
+    def render(self) -> str:
+        '''
+        Get all metrics in Prometheus text format.
+        '''
+        lines = []
+        typed = set()
+        for (name, labels), metric in sorted(self._metrics.items(), key=lambda i: i[0]):
+            if isinstance(metric, Counter):
+                if name not in typed:
+                    lines.append(f'# TYPE {name} counter')
+                    typed.add(name)
+                lines.append(f'{name}{self._labels(labels)} {metric.value}')
+                continue
+            if name not in typed:
+                lines.append(f'# TYPE {name} histogram')
+                typed.add(name)
+            with metric._lock:
+                counts, total, count = list(metric.counts), metric.sum, metric.count
+            cumulative = 0
+            for bound, value in zip(metric.buckets + ('+Inf',), counts):
+                cumulative += value
+                lines.append(f'{name}_bucket{self._labels(labels, f"le={chr(34)}{bound}{chr(34)}")} {cumulative}')
+            lines.append(f'{name}_sum{self._labels(labels)} {total}')
+            lines.append(f'{name}_count{self._labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        '''
+        Get short human readable summary: counter values, histogram count and mean.
+        '''
+        lines = []
+        for (name, labels), metric in sorted(self._metrics.items(), key=lambda i: i[0]):
+            if isinstance(metric, Counter):
+                lines.append(f'{name}{self._labels(labels)} {metric.value}')
+            elif metric.count:
+                lines.append(f'{name}{self._labels(labels)} count={metric.count} '
+                             f'mean={metric.sum/metric.count*1000:.2f}ms')
+        return '\n'.join(lines)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REGISTRY = Registry()
+
+
+def counter(name : str, **labels) -> Counter:
+    return REGISTRY.counter(name, **labels)
+
+
+def histogram(name : str, **labels) -> Histogram:
+    return REGISTRY.histogram(name, **labels)
+
+
+def timed(name : str, **labels):
+    return REGISTRY.timed(name, **labels)
+
+
+def exposition() -> Tuple[str, str]:
+    '''
+    Get content type and body for /metrics answer.
+    '''
+    return CONTENT_TYPE, REGISTRY.render()
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        content_type, body = exposition()
+        body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_http_server(port : int, host : str = '0.0.0.0') -> ThreadingHTTPServer:
+    '''
+    Serve /metrics in background thread, return server to shutdown it.
+    '''
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+def start_log_dump(interval : float) -> threading.Event:
+    '''
+    Print metrics summary every interval seconds, set returned event to stop.
+    '''
+    stop = threading.Event()
+
+    def dump():
+        while not stop.wait(interval):
+            print('Metrics'.center(50,'_'))
+            print(REGISTRY.summary())
+    threading.Thread(target=dump, name='metrics-dump', daemon=True).start()
+    return stop
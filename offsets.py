@@ -0,0 +1,115 @@
+'''
+This module implements durable getUpdates offset with deduplication of recently handled updates.
+
+Classes:
+    OffsetStore : last handled update_id and recent update ids kept in small json side file
+'''
+
+from typing import Optional
+from collections import deque
+import json
+import os
+import threading
+import time
+
+#telegram picks random next update_id after a week without updates
+MAX_AGE = 6*24*60*60
+
+
+class OffsetStore:
+    '''
+    Keeps offset for getUpdates and set of seen_size recently handled update ids.
+    Writes are batched, file is rewritten after commit_every handled updates,
+    by timer commit_interval seconds after first not written update, and on close.
+    Without file_name nothing is written, store only skips duplicates.
+    '''
+
+    def __init__(self, file_name : str = None, commit_every : int = 100, commit_interval : float = 5,
+                 seen_size : int = 1000):
+        self.file_name = file_name
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self._offset = None
+        self._seen = set()
+        self._order = deque(maxlen=seen_size)
+        self._uncommitted = 0
+        self._timer = None
+        self._lock = threading.Lock()
+        if file_name:
+            self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.file_name, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        if time.time() - state.get('time', 0) > MAX_AGE:
+            return
+        self._offset = state.get('offset')
+        for update_id in state.get('seen', ()):
+            self._remember(update_id)
+
+    @property
+    def offset(self) -> Optional[int]:
+        '''
+        Offset for next getUpdates, None if nothing was handled yet.
+        '''
+        return self._offset
+
+    def seen(self, update_id : int) -> bool:
+        '''
+        Check update was already handled.
+        '''
+        return update_id in self._seen
+
+    def _remember(self, update_id : int) -> None:
+        if len(self._order) == self._order.maxlen:
+            self._seen.discard(self._order[0])
+        self._order.append(update_id)
+        self._seen.add(update_id)
+
+    def mark(self, update_id : int) -> None:
+        '''
+        Remember handled update and move offset past it, commit if batch is full,
+        otherwise timer commits it, so idle bot doesn't keep updates unwritten.
+        '''
+        with self._lock:
+            if update_id in self._seen:
+                return
+            self._remember(update_id)
+            if self._offset is None or update_id >= self._offset:
+                self._offset = update_id + 1
+            self._uncommitted += 1
+            due = self._uncommitted >= self.commit_every
+            if not due and self.file_name and self._timer is None:
+                self._timer = threading.Timer(self.commit_interval, self.commit)
+                self._timer.daemon = True
+                self._timer.start()
+        if due:
+            self.commit()
+
+    def commit(self) -> None:
+        '''
+        Write offset and seen update ids to file, file is replaced atomically.
+        '''
+        if not self.file_name:
+            return
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._uncommitted:
+                return
+            state = {'offset': self._offset, 'seen': list(self._order), 'time': time.time()}
+            self._uncommitted = 0
+            tmp_name = f'{self.file_name}.tmp'
+            with open(tmp_name, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_name, self.file_name)
+
+    def close(self) -> None:
+        '''
+        Commit not written updates.
+        '''
+        self.commit()
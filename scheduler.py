@@ -0,0 +1,299 @@
+'''
+This module implements scheduler that celebrates birthdays exactly when they are due.
+
+Classes:
+    BirthdayScheduler : min-heap of upcoming birthdays with own timer thread
+    WeeklyJob : calls function once a week at selected weekday and hour
+
+Functions:
+    next_occurrence : nearest date of birthday not earlier than selected day
+'''
+
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+import datetime
+import heapq
+import itertools
+import threading
+import time
+
+from database import Birthday
+
+
+def next_occurrence(birth_date : datetime.date, day : datetime.date) -> datetime.date:
+    '''
+    Get nearest date of birthday not earlier than day.
+    Birthday on 29 February is celebrated on 28 February in non-leap years.
+    '''
+    for year in (day.year, day.year + 1):
+        try:
+            date = birth_date.replace(year=year)
+        except ValueError:
+            date = datetime.date(year, 2, 28)
+        if date >= day:
+            return date
+
+
+class BirthdayScheduler:
+    '''
+    Keeps min-heap of (due time, birthday) for next celebration of every birthday.
+    Heap is built once with load and changed with add and remove, own thread sleeps
+    until the nearest celebration and passes all due birthdays to on_due.
+    Birthday is due at midnight of its day in timezone of its chat, so birthdays are
+    dispatched in timezone buckets as every zone reaches midnight.
+    '''
+
+    #longest sleep, so the scheduler notices system clock changes
+    max_sleep = 60
+
+    def __init__(self, on_due : Callable[[List[Birthday]], None],
+                 timezone_of : Callable[[int], Optional[str]] = None):
+        '''
+        BirthdayScheduler constructor.
+        on_due is called from scheduler thread with list of due birthdays.
+        timezone_of returns IANA timezone name of chat or None for server local time.
+        '''
+        self.on_due = on_due
+        self.timezone_of = timezone_of or (lambda chat_id: None)
+        #heap of (due timestamp, seq, birthday), removed birthdays stay in heap until popped
+        self._heap = []
+        #(chat_id, name) -> (seq, due timestamp) of actual heap entry
+        self._entries = {}
+        self._seq = itertools.count()
+        #(timezone, date) -> timestamp of midnight
+        self._midnights = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _local_day(tz : Optional[str], now : float) -> datetime.date:
+        if tz is None:
+            return datetime.date.fromtimestamp(now)
+        return datetime.datetime.fromtimestamp(now, ZoneInfo(tz)).date()
+
+    def local_date(self, chat_id : int, now : float = None) -> datetime.date:
+        '''
+        Get current date in timezone of chat.
+        '''
+        return self._local_day(self.timezone_of(chat_id), now or time.time())
+
+    def _due(self, birthday : Birthday, tz : Optional[str], day : datetime.date) -> float:
+        '''
+        Get timestamp of next celebration of birthday not earlier than day.
+        '''
+        date = next_occurrence(birthday.date, day)
+        due = self._midnights.get((tz, date))
+        if due is None:
+            zone = ZoneInfo(tz) if tz is not None else None
+            due = datetime.datetime.combine(date, datetime.time(), tzinfo=zone).timestamp()
+            self._midnights[(tz, date)] = due
+        return due
+
+    def _entry(self, birthday : Birthday, now : float, days : Dict, skip_today : bool = False,
+               celebrated : Dict[int, datetime.date] = None) -> Tuple:
+        '''
+        Make heap entry for next celebration of birthday.
+        days is cache of timezone -> local date at now, shared by calls with the same now.
+        Today is skipped if skip_today is set or celebrated has local date of today for chat of birthday.
+        '''
+        tz = self.timezone_of(birthday.chat_id)
+        day = days.get(tz)
+        if day is None:
+            day = days[tz] = self._local_day(tz, now)
+        if skip_today or (celebrated and celebrated.get(birthday.chat_id, datetime.date.min) >= day):
+            day += datetime.timedelta(days=1)
+        return self._make_entry(birthday, tz, day)
+
+    def _make_entry(self, birthday : Birthday, tz : Optional[str], day : datetime.date) -> Tuple:
+        '''
+        Make heap entry for celebration of birthday not earlier than day and mark it actual.
+        '''
+        seq = next(self._seq)
+        due = self._due(birthday, tz, day)
+        self._entries[(birthday.chat_id, birthday.name)] = (seq, due)
+        return (due, seq, birthday)
+
+    def load(self, birthdays : Iterable[Birthday], now : float = None,
+             celebrated : Dict[int, datetime.date] = None) -> None:
+        '''
+        Replace scheduled birthdays, birthdays of today are due at once.
+        celebrated is chat_id -> local date when chat was last celebrated, e.g. before restart,
+        birthdays of today in these chats are scheduled for the next year.
+        '''
+        now = now or time.time()
+        days = {}
+        with self._cond:
+            self._entries = {}
+            self._midnights = {}
+            self._heap = [self._entry(i, now, days, celebrated=celebrated) for i in birthdays]
+            heapq.heapify(self._heap)
+            self._cond.notify()
+
+    def add(self, birthday : Birthday, skip_today : bool = False, now : float = None) -> None:
+        '''
+        Schedule birthday, replace previous birthday with the same name and chat.
+        If skip_today is set birthday of today is scheduled for the next year.
+        '''
+        with self._cond:
+            heapq.heappush(self._heap, self._entry(birthday, now or time.time(), {}, skip_today))
+            self._cond.notify()
+
+    def reschedule_chat(self, birthdays : Iterable[Birthday], old_tz : Optional[str], now : float = None) -> None:
+        '''
+        Reschedule birthdays of chat after its timezone changed from old_tz.
+        Birthdays already celebrated today in old timezone are not celebrated again.
+        '''
+        now = now or time.time()
+        with self._cond:
+            for i in birthdays:
+                tz = self.timezone_of(i.chat_id)
+                day = self._local_day(tz, now)
+                current = next_occurrence(i.date, day)
+                old = self._entries.get((i.chat_id, i.name))
+                #entry is moved to the next year right after celebration
+                if old is not None and self._local_day(old_tz, old[1]) > current:
+                    day = current + datetime.timedelta(days=1)
+                heapq.heappush(self._heap, self._make_entry(i, tz, day))
+            self._cond.notify()
+
+    def remove(self, name : str, chat_id : int) -> None:
+        '''
+        Unschedule birthday.
+        '''
+        with self._cond:
+            self._entries.pop((chat_id, name), None)
+            #drop removed entries when they take most of heap
+            if len(self._heap) > 2*len(self._entries) + 1000:
+                self._heap = [i for i in self._heap if self._is_actual(i)]
+                heapq.heapify(self._heap)
+
+    def next_due(self) -> Optional[float]:
+        '''
+        Get timestamp of the nearest celebration.
+        '''
+        with self._cond:
+            self._drop_removed()
+            return self._heap[0][0] if self._heap else None
+
+    def _is_actual(self, entry : Tuple) -> bool:
+        actual = self._entries.get((entry[2].chat_id, entry[2].name))
+        return actual is not None and actual[0] == entry[1]
+
+    def _drop_removed(self) -> None:
+        heap = self._heap
+        while heap and not self._is_actual(heap[0]):
+            heapq.heappop(heap)
+
+    def pop_due(self, now : float = None) -> List[Birthday]:
+        '''
+        Pop birthdays due at now and schedule their next celebration.
+        '''
+        now = now or time.time()
+        due = []
+        with self._cond:
+            heap = self._heap
+            while True:
+                self._drop_removed()
+                if not heap or heap[0][0] > now:
+                    break
+                _, _, birthday = heapq.heappop(heap)
+                due.append(birthday)
+            days = {}
+            for birthday in due:
+                heapq.heappush(heap, self._entry(birthday, now, days, skip_today=True))
+        return due
+
+    def start(self) -> 'BirthdayScheduler':
+        '''
+        Start scheduler thread.
+        '''
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout : float = None) -> None:
+        '''
+        Stop scheduler thread.
+        '''
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                due = self.next_due()
+                delay = self.max_sleep if due is None else min(due - time.time(), self.max_sleep)
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+            birthdays = self.pop_due()
+            if birthdays:
+                try:
+                    self.on_due(birthdays)
+                except Exception as e:
+                    print(f'Scheduler error: {e!r}')
+
+
+class WeeklyJob:
+    '''
+    Calls func from own thread every week at weekday (0 is Monday) and hour of server local time.
+    '''
+
+    #longest sleep, so the job notices system clock changes
+    max_sleep = 60
+
+    def __init__(self, func : Callable[[], None], weekday : int = 0, hour : int = 9):
+        self.func = func
+        self.weekday = weekday
+        self.hour = hour
+        self._stop = threading.Event()
+        self._thread = None
+
+    def next_run(self, now : float = None) -> float:
+        '''
+        Get timestamp of next call after now.
+        '''
+        now = datetime.datetime.fromtimestamp(now or time.time())
+        date = now.date() + datetime.timedelta(days=(self.weekday - now.weekday()) % 7)
+        due = datetime.datetime.combine(date, datetime.time(self.hour))
+        if due <= now:
+            due += datetime.timedelta(days=7)
+        return due.timestamp()
+
+    def start(self) -> 'WeeklyJob':
+        '''
+        Start job thread.
+        '''
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='weekly-job', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout : float = None) -> None:
+        '''
+        Stop job thread.
+        '''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self) -> None:
+        due = self.next_run()
+        while not self._stop.wait(max(0, min(due - time.time(), self.max_sleep))):
+            if time.time() < due:
+                continue
+            due = self.next_run()
+            try:
+                self.func()
+            except Exception as e:
+                print(f'Weekly job error: {e!r}')
@@ -0,0 +1,258 @@
+'''
+This module implements rate limited queue for outgoing messages.
+Telegram allows about 30 messages per second overall and 1 message per second to one chat,
+queue keeps sending under these limits in background threads.
+
+Classes:
+    TokenBucket : token bucket rate limiter
+    Delivery : status of queued message
+    SendQueue : outgoing messages queue with worker threads
+'''
+
+from typing import Dict, Optional
+from collections import deque
+import heapq
+import threading
+import time
+
+
+class TokenBucket:
+    '''
+    Token bucket, refills rate tokens per second up to capacity.
+    Not thread safe, SendQueue calls it under its lock.
+    '''
+
+    def __init__(self, rate : float, capacity : float = None):
+        '''
+        TokenBucket constructor.
+        '''
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+
+    def _refill(self, now : float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._last)*self.rate)
+        self._last = now
+
+    def wait_time(self, now : float) -> float:
+        '''
+        Get how many seconds left until next token.
+        '''
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens)/self.rate
+
+    def take(self, now : float) -> None:
+        '''
+        Take one token.
+        '''
+        self._refill(now)
+        self._tokens -= 1
+
+
+class Delivery:
+    '''
+    Status of message in SendQueue.
+    status is one of 'queued', 'sent', 'failed'.
+    '''
+
+    def __init__(self, chat_id : int, text : str, markup = None):
+        self.chat_id = chat_id
+        self.text = text
+        self.markup = markup
+        self.status = 'queued'
+        self.attempts = 0
+        self.error = None
+        self._done = threading.Event()
+
+    def __repr__(self):
+        return f'Delivery(chat_id={self.chat_id}, status={self.status}, attempts={self.attempts})'
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout : float = None) -> bool:
+        '''
+        Wait until message is sent or failed. Return False on timeout.
+        '''
+        return self._done.wait(timeout)
+
+    def _finish(self, status : str, error = None) -> None:
+        self.status = status
+        self.error = error
+        self._done.set()
+
+
+class SendQueue:
+    '''
+    Queue of outgoing messages. Messages of one chat are sent in order,
+    not faster than chat_rate per second, all messages not faster than global_rate.
+    On 429 answer message is resent after retry_after seconds from answer, on 5xx answer
+    or connection error after exponential backoff. Other 4xx answers, e.g. blocked bot
+    or deleted chat, won't change on retry, so message fails at once.
+    '''
+
+    def __init__(self, bot, workers : int = 8, global_rate : float = 30, chat_rate : float = 1,
+                 max_retries : int = 5, global_burst : float = 1):
+        '''
+        SendQueue constructor.
+        bot is object with send_message(chat_id, text, markup) method, e.g. BotHandler.
+        At most global_burst messages go out at once above global_rate, 1 keeps queue under limit in any second.
+        '''
+        self.bot = bot
+        self.workers = workers
+        self.chat_interval = 1/chat_rate
+        self.max_retries = max_retries
+        self.global_burst = global_burst
+        self.stats = {'queued': 0, 'sent': 0, 'failed': 0, 'retried': 0, 'too_many_requests': 0}
+        self._bucket = TokenBucket(global_rate, global_burst)
+        self._cond = threading.Condition()
+        #chat_id -> deque of deliveries
+        self._chats = {}
+        #chat_id -> time when chat can get next message
+        self._chat_ready = {}
+        #heap of (ready time, chat_id) for chats with messages and nothing in flight
+        self._ready = []
+        self._threads = []
+        self._stopped = False
+
+    def start(self) -> 'SendQueue':
+        '''
+        Start worker threads.
+        '''
+        self._stopped = False
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'sender-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout : float = None) -> None:
+        '''
+        Stop workers after they sent messages in flight, queued messages are left unsent.
+        '''
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads.clear()
+
+    def set_global_rate(self, rate : float) -> None:
+        '''
+        Change global messages per second limit, e.g. to share it between processes.
+        '''
+        with self._cond:
+            self._bucket = TokenBucket(rate, self.global_burst)
+
+    def pending(self) -> int:
+        '''
+        Get number of messages waiting in queue.
+        '''
+        with self._cond:
+            return sum(len(i) for i in self._chats.values())
+
+    def send_message(self, chat_id : int, text : str, markup = None) -> Delivery:
+        '''
+        Put message to queue and return its Delivery.
+        '''
+        delivery = Delivery(chat_id, text, markup)
+        with self._cond:
+            self.stats['queued'] += 1
+            messages = self._chats.get(chat_id)
+            if messages is None:
+                messages = self._chats[chat_id] = deque()
+                self._schedule(chat_id, self._chat_ready.pop(chat_id, 0))
+            messages.append(delivery)
+            self._cond.notify()
+        return delivery
+
+    def _schedule(self, chat_id : int, ready : float) -> None:
+        heapq.heappush(self._ready, (ready, chat_id))
+
+    def _next(self) -> Optional[Delivery]:
+        '''
+        Wait for message allowed to send, return None when queue is stopped.
+        '''
+        with self._cond:
+            while not self._stopped:
+                now = time.monotonic()
+                if not self._ready:
+                    self._cond.wait()
+                    continue
+                ready, chat_id = self._ready[0]
+                delay = max(ready - now, self._bucket.wait_time(now))
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._ready)
+                self._bucket.take(now)
+                #chat stays out of heap until its message is sent
+                return self._chats[chat_id].popleft()
+        return None
+
+    def _done(self, delivery : Delivery, error = None, retry_after : float = None, permanent : bool = False) -> None:
+        '''
+        Finish or requeue sent message and return its chat to schedule.
+        Message with permanent error is not retried.
+        '''
+        chat_id = delivery.chat_id
+        with self._cond:
+            messages = self._chats[chat_id]
+            if error is None:
+                self.stats['sent'] += 1
+                delivery._finish('sent')
+            elif permanent or delivery.attempts > self.max_retries:
+                self.stats['failed'] += 1
+                delivery._finish('failed', error)
+            else:
+                self.stats['retried'] += 1
+                messages.appendleft(delivery)
+            ready = time.monotonic() + max(self.chat_interval, retry_after or 0)
+            if messages:
+                self._schedule(chat_id, ready)
+            else:
+                del self._chats[chat_id]
+                self._chat_ready[chat_id] = ready
+                if len(self._chat_ready) > 10000:
+                    now = time.monotonic()
+                    self._chat_ready = {k: v for k, v in self._chat_ready.items() if v > now}
+            self._cond.notify()
+
+    @staticmethod
+    def _retry_after(resp) -> float:
+        '''
+        Get retry_after from 429 answer.
+        '''
+        try:
+            return float(resp.json()['parameters']['retry_after'])
+        except (ValueError, KeyError, TypeError):
+            return float(resp.headers.get('Retry-After', 1))
+
+    def _worker(self) -> None:
+        while True:
+            delivery = self._next()
+            if delivery is None:
+                return
+            delivery.attempts += 1
+            error = None
+            retry_after = None
+            permanent = False
+            try:
+                resp = self.bot.send_message(delivery.chat_id, delivery.text, delivery.markup)
+                if resp.status_code == 429:
+                    with self._cond:
+                        self.stats['too_many_requests'] += 1
+                    error = 'Too Many Requests'
+                    retry_after = self._retry_after(resp)
+                elif not resp.ok:
+                    error = f'HTTP {resp.status_code}'
+                    permanent = resp.status_code < 500
+            except Exception as e:
+                error = e
+            if error is not None and retry_after is None and not permanent:
+                retry_after = 2**delivery.attempts
+            self._done(delivery, error, retry_after, permanent)
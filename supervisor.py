@@ -0,0 +1,201 @@
+'''
+This module implements supervisor mode. Supervisor process recieves updates with getUpdates
+or webhook and passes them to worker processes, chat always goes to the same worker,
+so updates of one chat are handled in order. Every worker runs main.py handlers,
+scheduler and sending queue for its chats, workers share database in WAL mode.
+
+Usage:
+    python supervisor.py [-w WORKERS] [-p PORT]
+
+Classes:
+    Supervisor : pool of worker processes with queue per worker
+    ShardedBotHandler : BotHandler that passes updates to Supervisor
+
+Functions:
+    shard_of : worker index for chat
+'''
+
+from typing import Dict, List
+import argparse
+import multiprocessing
+import os
+import signal
+import time
+
+from database import Database
+from offsets import OffsetStore
+from tbot import BotHandler, update_chat_id
+
+
+def shard_of(chat_id : int, workers : int) -> int:
+    '''
+    Get index of worker for chat.
+    '''
+    return chat_id % workers
+
+
+def worker_main(index : int, workers : int, updates, ready) -> None:
+    '''
+    Worker process, handles updates of its chats until None comes from queue.
+    '''
+    #supervisor stops workers through queue after they finish queued updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    import main
+    main.start_services(shard=lambda chat_id: shard_of(chat_id, workers) == index, rate_share=1/workers)
+    ready.set()
+    try:
+        while True:
+            batch = updates.get()
+            if batch is None:
+                break
+            try:
+                #worker bot has handlers of main.py, so repeats are merged here, not in supervisor
+                main.my_bot.process_updates(main.my_bot.coalesce_updates(batch))
+            except Exception as e:
+                print(f'Worker {index} error: {e!r}')
+    finally:
+        main.stop_services()
+
+
+class Supervisor:
+    '''
+    Pool of worker processes, every worker has own queue of updates.
+    '''
+
+    def __init__(self, workers : int = None):
+        '''
+        Supervisor constructor, default number of workers is number of CPUs.
+        '''
+        self.workers = workers or os.cpu_count() or 1
+        #spawn, so workers don't inherit threads and sqlite connections of supervisor
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = [self._context.Queue() for _ in range(self.workers)]
+        self._ready = [self._context.Event() for _ in range(self.workers)]
+        self._processes = []
+
+    def _spawn(self, index : int):
+        self._ready[index] = self._context.Event()
+        process = self._context.Process(target=worker_main, name=f'worker-{index}',
+                                        args=(index, self.workers, self._queues[index], self._ready[index]))
+        process.start()
+        return process
+
+    def _wait_ready(self, indexes : List[int], timeout : float) -> None:
+        '''
+        Wait until workers are ready, stop all workers and raise RuntimeError if some is not.
+        '''
+        deadline = time.monotonic() + timeout
+        for i in indexes:
+            process = self._processes[i]
+            while not self._ready[i].wait(min(1, max(0, deadline - time.monotonic()))):
+                if not process.is_alive() or time.monotonic() >= deadline:
+                    self.stop(0)
+                    raise RuntimeError(f'Worker {i} failed to start, exit code {process.exitcode}')
+
+    def start(self, timeout : float = 60) -> 'Supervisor':
+        '''
+        Start workers and wait until they are ready, raise RuntimeError if some worker fails to start.
+        '''
+        self._processes = [self._spawn(i) for i in range(self.workers)]
+        self._wait_ready(range(self.workers), timeout)
+        return self
+
+    def restart_dead(self, timeout : float = 60) -> List[int]:
+        '''
+        Start again workers that died, return their indexes.
+        Dead worker could hold lock of its queue, so new worker gets new queue
+        and batches queued to dead worker are lost.
+        '''
+        dead = [i for i, process in enumerate(self._processes) if not process.is_alive()]
+        for i in dead:
+            print(f'Worker {i} died with exit code {self._processes[i].exitcode}, restarting')
+            self._queues[i] = self._context.Queue()
+            self._processes[i] = self._spawn(i)
+        if dead:
+            self._wait_ready(dead, timeout)
+        return dead
+
+    def process_updates(self, updates : List[Dict]) -> None:
+        '''
+        Pass updates to workers of their chats, one batch per worker.
+        Dead workers are restarted first, so updates are not queued to nobody.
+        '''
+        self.restart_dead()
+        batches = [[] for _ in range(self.workers)]
+        for i in updates:
+            #updates without chat go to the first worker
+            batches[shard_of(update_chat_id(i) or 0, self.workers)].append(i)
+        for queue, batch in zip(self._queues, batches):
+            if batch:
+                queue.put(batch)
+
+    def stop(self, timeout : float = 30) -> None:
+        '''
+        Let workers finish queued updates and stop them.
+        '''
+        for queue in self._queues:
+            queue.put(None)
+        deadline = time.monotonic() + timeout
+        for process in self._processes:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                #workers ignore SIGTERM
+                process.kill()
+        self._processes.clear()
+
+
+class ShardedBotHandler(BotHandler):
+    '''
+    BotHandler that doesn't run handlers itself but passes updates to Supervisor.
+    '''
+
+    def __init__(self, token : str, supervisor : Supervisor, **kwargs):
+        super().__init__(token, **kwargs)
+        self.supervisor = supervisor
+
+    def process_updates(self, updates : List[Dict]) -> None:
+        self.supervisor.process_updates(updates)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Birthday bot with worker processes.')
+    parser.add_argument('-w', '--workers', type=int, default=None)
+    parser.add_argument('-p', '--port', type=int, default=None, help='port for webhook server')
+    args = parser.parse_args()
+
+    token = os.environ.get('TOKEN')
+    if os.path.exists('bot_token.txt'):
+        with open('bot_token.txt', 'r') as f:
+            token = f.read().strip()
+    db_name = os.environ.get('DB_NAME', 'data.db')
+    #migrate once here, not in every worker at the same time
+    Database(db_name).close()
+    supervisor = Supervisor(args.workers)
+    offset_file = os.environ.get('OFFSET_FILE', f'{db_name}.offset')
+    bot = ShardedBotHandler(token, supervisor, server=os.environ.get('TELEGRAM_API', 'https://api.telegram.org'),
+                            offset_store=OffsetStore(offset_file))
+
+    def handle_sigterm(signum, frame):
+        bot.stop()
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    supervisor.start()
+    print(f'Bot started with {supervisor.workers} workers!')
+    webhook_url = os.environ.get('WEBHOOK_URL')
+    try:
+        if webhook_url and args.port:
+            bot.run_webhook(webhook_url, args.port, secret_token=os.environ.get('WEBHOOK_SECRET'))
+            return
+        bot.run_polling()
+    except KeyboardInterrupt:
+        print('Bot stoped!')
+    finally:
+        bot.stop()
+        supervisor.stop()
+        bot.close()
+
+
+if __name__ == '__main__':
+    main()
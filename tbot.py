@@ -2,24 +2,152 @@
 This module implement classes to simplify work with telegram bot api.
 
 Classes:
+    CallbackCodec : compact encoding of callback handler and data to callback_data
     InlineButton : telegram inline button wraper
     Message : telegram message wrapper
     Callback : telegram callback wrapper
+    Dispatcher : routing table from commands and callbacks to handlers
     BotHandler : bot to work with telegram api
+    PagedKeyboard : inline keyboard split into pages with prev and next buttons
+    WebhookServer : http server that recieves updates from telegram webhook
+
+Functions:
+    text_length : length of text in UTF-16 code units
+    split_message : join lines into messages that fit telegram limit
+    update_chat_id : chat id of message or callback update
 '''
 
-from typing import List, Set, Tuple, Dict, Generator
+from typing import List, Set, Tuple, Dict, Generator, Optional, Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+import threading
+import queue
+import time
+import hmac
+import ast
+import base64
+import hashlib
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
 import json
 
+import metrics
+from cache import LRUCache
+from offsets import OffsetStore
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+#in UTF-16 code units, as telegram counts them
+MAX_MESSAGE_LENGTH = 4096
+
+
+def text_length(text : str) -> int:
+    '''
+    Get length of text as telegram counts it, in UTF-16 code units.
+    '''
+    return len(text.encode('utf-16-le')) // 2
+
+
+def split_message(lines : List[str], header : str = '', limit : int = MAX_MESSAGE_LENGTH) -> List[str]:
+    '''
+    Join lines into as few messages as possible, every message starts with header and fits limit.
+    Lines longer than limit are cut.
+    '''
+    messages = []
+    current = header
+    for line in lines:
+        separator = '\n' if current else ''
+        if text_length(current + separator + line) <= limit:
+            current += separator + line
+            continue
+        if current != header:
+            messages.append(current)
+        current = header + ('\n' if header else '') + line
+        while text_length(current) > limit:
+            #cut by code points, surrogate pairs never get split
+            cut = limit
+            while text_length(current[:cut]) > limit:
+                cut -= 1
+            messages.append(current[:cut])
+            current = current[cut:]
+    if current and (current != header or not messages):
+        messages.append(current)
+    return messages
+
+
+def update_chat_id(update : Dict) -> Optional[int]:
+    '''
+    Get chat id of message or callback update, None for other updates.
+    '''
+    if update.get('message', False):
+        return update['message']['chat']['id']
+    if update.get('callback_query', False):
+        return update['callback_query']['message']['chat']['id']
+    return None
+
+
+class CallbackCodec:
+    '''
+    Encodes handler name and data of inline button to callback_data and back.
+    Short payloads are stored as "handler:data", payloads longer than telegram limit
+    of 64 bytes or with non string data are kept in registry and sent as "~token".
+    Tokens are derived from payload, so the same button always gets the same token.
+    Registry lives in memory, buttons with token sent before restart are decoded as (None, None).
+    '''
+
+    max_bytes = 64
+    token_prefix = '~'
+
+    def __init__(self, registry_size : int = 65536):
+        '''
+        CallbackCodec constructor, registry keeps registry_size recently used payloads.
+        '''
+        self.registry = LRUCache(registry_size)
+
+    def encode(self, handler : Optional[str], data) -> str:
+        '''
+        Get callback_data for handler and data.
+        '''
+        handler = handler or ''
+        if type(data) == str and ':' not in handler and not handler.startswith((self.token_prefix, '{')):
+            callback_data = f'{handler}:{data}'
+            if len(callback_data.encode()) <= self.max_bytes:
+                return callback_data
+        payload = (handler or None, data)
+        digest = hashlib.blake2b(repr(payload).encode(), digest_size=9).digest()
+        token = self.token_prefix + base64.urlsafe_b64encode(digest).decode()
+        self.registry.put(token, payload)
+        return token
+
+    def decode(self, callback_data : str) -> Tuple[Optional[str], object]:
+        '''
+        Get (handler, data) from callback_data, (None, None) if token is unknown.
+        '''
+        if callback_data.startswith(self.token_prefix):
+            return self.registry.get(callback_data, (None, None))
+        if callback_data.startswith('{'):
+            #dict repr of buttons sent by older versions
+            try:
+                payload = ast.literal_eval(callback_data)
+            except (ValueError, SyntaxError):
+                return None, callback_data
+            if type(payload) == dict:
+                return payload.get('handler', None), payload.get('data', None)
+            return None, payload
+        handler, _, data = callback_data.partition(':')
+        return handler or None, data
+
+
+callback_codec = CallbackCodec()
+
 
 class InlineButton:
     '''
     Class wrapper that helps to create inline buttons for inline keyboards.
     '''
     def __init__(self, text, data, handler_name = None):
-        self._button = {"text": text, "callback_data": str({"handler" : handler_name ,"data" : data})}
+        self._button = {"text": text, "callback_data": callback_codec.encode(handler_name, data)}
     
     @property
     def button_dict(self):
@@ -68,9 +196,7 @@ class Callback:
     def __init__(self, callback_json):
         self._message = Message(callback_json['message'])
         self._callback_id = callback_json['id']
-        #Looks not very good, we need to replace ' to " to use json.loads
-        self._data = json.loads(callback_json["data"].replace("'",'"'))
-        # self._data = dict(callback_json['data'])
+        self._handler, self._data = callback_codec.decode(callback_json.get('data', ''))
 
     @property
     def message(self):
@@ -86,37 +212,188 @@ class Callback:
 
     @property
     def data(self):
-        data = self._data
-        if type(data) == dict:
-            return data.get('data', None)
-        return data
+        return self._data
 
     @property
     def handler(self):
-        handler = None
-        if type(self._data) == dict:
-            handler = self._data.get('handler', None)
-        return handler
+        return self._handler
 
     @property
     def chat_id(self):
         return self._message.chat_id
 
 
+class Dispatcher:
+    '''
+    Routing table for handlers. Command of message is parsed once
+    and its handlers are found with dict lookup, as callback handlers by Callback.handler.
+    '''
+
+    def __init__(self, bot_name : str = None):
+        '''
+        Dispatcher constructor.
+        If bot_name is set, commands addressed to other bots (/cmd@other_bot) are ignored.
+        '''
+        self.bot_name = bot_name
+        self._message_handlers = []
+        self._command_handlers = {}
+        self._callback_handlers = {}
+        #commands and callback handlers whose repeated updates can be merged
+        self.coalesced_commands = set()
+        self.coalesced_callbacks = set()
+
+    def parse_command(self, text : str) -> Optional[str]:
+        '''
+        Get leading bot command of text without @botname suffix.
+        '''
+        if not text.startswith('/'):
+            return None
+        command, _, name = text.split(maxsplit=1)[0].partition('@')
+        if name and self.bot_name and name.lower() != self.bot_name.lower():
+            return None
+        return command
+
+    def add_message_handler(self, func : Callable) -> None:
+        '''
+        Add handler called for every message.
+        '''
+        self._message_handlers.append(func)
+
+    def add_command_handler(self, command : str, func : Callable, coalesce : bool = False) -> None:
+        '''
+        Add handler called for messages starting with command.
+        If coalesce is set command is idempotent and repeated messages with it can be merged.
+        '''
+        self._command_handlers.setdefault(command, []).append(func)
+        if coalesce:
+            self.coalesced_commands.add(command)
+
+    def add_callback_handler(self, handler_name : str, func : Callable, coalesce : bool = False) -> None:
+        '''
+        Add handler called for callbacks with selected handler name.
+        If coalesce is set handler is idempotent and repeated callbacks on the same message can be merged.
+        '''
+        self._callback_handlers.setdefault(handler_name, []).append(func)
+        if coalesce:
+            self.coalesced_callbacks.add(handler_name)
+
+    def coalesce_key(self, update : Dict) -> Tuple[Optional[int], Optional[Tuple], Optional[str]]:
+        '''
+        Get (chat_id, key, command or handler name) of update, key is None if update can't be merged.
+        Updates of chat with equal keys give the same result.
+        '''
+        chat_id = update_chat_id(update)
+        if chat_id is None:
+            return None, None, None
+        if update.get('message', False):
+            text = update['message'].get('text', '')
+            command = self.parse_command(text)
+            if command in self.coalesced_commands:
+                return chat_id, ('message', text.strip()), command
+            return chat_id, None, None
+        callback = update['callback_query']
+        data = callback.get('data', '')
+        handler = callback_codec.decode(data)[0]
+        if handler in self.coalesced_callbacks:
+            return chat_id, ('callback', callback['message']['message_id'], data), f'callback:{handler}'
+        return chat_id, None, None
+
+    def message_handlers(self, message : Message) -> List[Callable]:
+        '''
+        Get handlers for message.
+        '''
+        command = self.parse_command(message.text)
+        if command is None:
+            return self._message_handlers
+        return self._message_handlers + self._command_handlers.get(command, [])
+
+    def callback_handlers(self, callback : Callback) -> List[Callable]:
+        '''
+        Get handlers for callback.
+        '''
+        return self._callback_handlers.get(callback.handler, [])
+
+
 class BotHandler:
     '''
     Class that help works with telegram bot API.
     '''
 
-    def __init__(self, token : str):
+    def __init__(self, token : str, server : str = 'https://api.telegram.org', pool_size : int = 10,
+                 timeout : float = 10, retries : int = 3, backoff : float = 0.5, bot_name : str = None,
+                 offset_store : OffsetStore = None, coalesce_window : float = 0):
         '''
         Bot constructor.
+        All requests go through one keep-alive session with pool of pool_size connections.
+        timeout is connect and read timeout in seconds, failed requests are retried
+        retries times with exponential backoff.
+        bot_name is used to skip commands addressed to other bots.
+        offset_store keeps offset between restarts and skips already handled updates,
+        by default it only skips duplicates in memory.
+        Repeated idempotent commands of chat are merged within one batch of updates,
+        or within coalesce_window seconds if it is set.
         '''
         self.token = token
-        self.api_url = "https://api.telegram.org/bot{}/".format(token)
-        self._offset = None
-        self._message_handler_queue = []
-        self._callback_handler_queue = []
+        self.api_url = "{}/bot{}/".format(server.rstrip('/'), token)
+        self.timeout = timeout
+        self.offset_store = offset_store or OffsetStore()
+        self._offset = self.offset_store.offset
+        self.dispatcher = Dispatcher(bot_name)
+        self._stopped = False
+        self._session = self._create_session(pool_size, retries, backoff)
+        self.coalesce_window = coalesce_window
+        #chat_id -> {coalesce key -> monotonic time until repeats are merged}
+        self._recent = {}
+        self._recent_lock = threading.Lock()
+
+    @staticmethod
+    def _create_session(pool_size : int, retries : int, backoff : float) -> requests.Session:
+        '''
+        Create session with connection pool and retry policy.
+        '''
+        #POST is not retried on bad status, message could be already sent
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(502, 503, 504),
+                      respect_retry_after_header=True, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def close(self) -> None:
+        '''
+        Close session and all pooled connections, commit offset.
+        '''
+        self._session.close()
+        self.offset_store.close()
+
+    def _request(self, http_method : str, method : str, **kwargs) -> requests.Response:
+        '''
+        Make request to bot API method, observe its duration and count failed and 429 answers.
+        '''
+        start = time.perf_counter()
+        try:
+            resp = self._session.request(http_method, self.api_url + method, **kwargs)
+        except Exception:
+            metrics.counter('api_errors_total', method=method).inc()
+            raise
+        finally:
+            metrics.histogram('api_request_seconds', method=method).observe(time.perf_counter() - start)
+        if resp.status_code == 429:
+            metrics.counter('api_too_many_requests_total', method=method).inc()
+        elif resp.status_code >= 400:
+            metrics.counter('api_errors_total', method=method).inc()
+        return resp
+
+    @property
+    def stopped(self) -> bool:
+        return self._stopped
+
+    def stop(self) -> None:
+        '''
+        Ask polling loop to finish, it checks stopped between polling calls.
+        '''
+        self._stopped = True
 
     def get_updates(self, offset : int = None, timeout : int = 30) -> Dict:
         '''
@@ -124,7 +401,8 @@ class BotHandler:
         '''
         method = 'getUpdates'
         params = {'timeout': timeout, 'offset': offset}
-        resp = requests.get(self.api_url + method, params)
+        #long polling holds request for timeout seconds
+        resp = self._request('GET', method, params=params, timeout=(self.timeout, self.timeout + timeout))
         result_json = resp.json()['result']
         return result_json
 
@@ -134,26 +412,31 @@ class BotHandler:
         '''
         params = {'chat_id': chat_id, 'text': text, 'reply_markup' : markup}
         method = 'sendMessage'
-        resp = requests.post(self.api_url + method, data=params)
+        resp = self._request('POST', method, data=params, timeout=self.timeout)
         return resp
 
     def send_inline_keyboard(self, chat_id : int, text : str, buttons : List[List[InlineButton]]) -> Dict:
         '''
         Send inline keyboard to chat.
         '''
-        buttons = [[j.button_dict for j in i] for i in buttons]
-        markup = json.dumps({"inline_keyboard" : buttons })
-
-        resp = self.send_message(chat_id, text, markup)
+        resp = self.send_message(chat_id, text, self.keyboard_markup(buttons))
         return resp
 
+    @staticmethod
+    def keyboard_markup(buttons : List[List[InlineButton]]) -> str:
+        '''
+        Get reply_markup json for inline keyboard.
+        '''
+        buttons = [[j.button_dict for j in i] for i in buttons]
+        return json.dumps({"inline_keyboard" : buttons })
+
     def edit_message(self, chat_id : int, message_id : int, text : str, markup = None) -> Dict:
         '''
         Edit message in chat.
         '''
         params = {'chat_id': chat_id, 'message_id' : message_id, 'text': text, 'reply_markup' : markup}
         method = 'editMessageText'
-        resp = requests.post(self.api_url + method, data=params)
+        resp = self._request('POST', method, data=params, timeout=self.timeout)
         return resp
 
     def get_last_updates(self, timeout : int = 30) -> Dict:
@@ -169,6 +452,21 @@ class BotHandler:
         #     self._offset = 0 #not sure about this
         return result_json
 
+    def set_webhook(self, url : str, secret_token : str = None, max_connections : int = 40) -> Dict:
+        '''
+        Make telegram send updates to url instead of getUpdates.
+        '''
+        params = {'url': url, 'secret_token': secret_token, 'max_connections': max_connections}
+        resp = self._request('POST', 'setWebhook', data=params, timeout=self.timeout)
+        return resp.json()
+
+    def delete_webhook(self) -> Dict:
+        '''
+        Remove webhook, so getUpdates works again.
+        '''
+        resp = self._request('POST', 'deleteWebhook', timeout=self.timeout)
+        return resp.json()
+
     def polling(self) -> None:
         '''
         Bot polling routine.
@@ -177,17 +475,100 @@ class BotHandler:
             updates = self.get_last_updates(200)
         except ValueError:
             return
+        start = time.perf_counter()
+        self.handle_updates(updates)
+        metrics.histogram('polling_batch_seconds').observe(time.perf_counter() - start)
+
+    def run_polling(self, max_delay : float = 5*60) -> None:
+        '''
+        Call polling until bot is stopped.
+        Session already retried failed request, so after connection error polling waits
+        longer every time, from 1 second up to max_delay.
+        '''
+        delay = 1
+        while not self.stopped:
+            try:
+                self.polling()
+                delay = 1
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                time.sleep(delay)
+                delay = min(delay*2, max_delay)
+
+    def run_webhook(self, url : str, port : int, host : str = '0.0.0.0', secret_token : str = None) -> None:
+        '''
+        Set webhook to url and serve updates on host:port until KeyboardInterrupt.
+        '''
+        server = WebhookServer(self, host, port, urlsplit(url).path or '/', secret_token)
+        result = self.set_webhook(url, secret_token)
+        if not result.get('ok'):
+            server.stop()
+            raise ConnectionError(f'setWebhook failed: {result.get("description")}')
+        try:
+            server.serve_forever()
+        finally:
+            server.stop()
 
+    def handle_updates(self, updates : List[Dict]) -> None:
+        '''
+        Skip already handled updates, process the rest and mark them handled in offset store.
+        '''
+        store = self.offset_store
+        new = [i for i in updates if not store.seen(i['update_id'])]
+        if len(new) < len(updates):
+            metrics.counter('updates_duplicate_total').inc(len(updates) - len(new))
+        coalesced = self.coalesce_updates(new)
+        if coalesced:
+            self.process_updates(coalesced)
+        for i in new:
+            store.mark(i['update_id'])
+
+    def coalesce_updates(self, updates : List[Dict]) -> List[Dict]:
+        '''
+        Drop repeats of idempotent commands and callbacks, see Dispatcher.coalesce_key.
+        Update is a repeat if chat had update with the same key in this batch or coalesce_window
+        and no other update in between. Dropped updates are counted in updates_coalesced_total.
+        '''
+        now = time.monotonic()
+        result = []
+        with self._recent_lock:
+            for i in updates:
+                chat_id, key, name = self.dispatcher.coalesce_key(i)
+                if chat_id is None:
+                    result.append(i)
+                    continue
+                recent = self._recent.setdefault(chat_id, {})
+                if key is None:
+                    #state of chat could change, older results are not valid anymore
+                    recent.clear()
+                    result.append(i)
+                    continue
+                until = recent.get(key)
+                if until is not None and until >= now:
+                    metrics.counter('updates_coalesced_total', handler=name).inc()
+                    continue
+                recent[key] = now + self.coalesce_window
+                result.append(i)
+            if not self.coalesce_window:
+                self._recent.clear()
+            elif len(self._recent) > 1000:
+                self._recent = {k: v for k, v in self._recent.items() if any(i >= now for i in v.values())}
+        return result
+
+    def process_updates(self, updates : List[Dict]) -> None:
+        '''
+        Run handlers for updates.
+        '''
+        metrics.counter('updates_total').inc(len(updates))
         messages = filter(lambda x: x.get('message', False), updates)
         callbacks = filter(lambda x: x.get('callback_query', False), updates)
 
         for i in messages:
             msg = Message(i['message'])
-            for j in self._message_handler_queue:
+            for j in self.dispatcher.message_handlers(msg):
                 j(msg)
         for i in callbacks:
             clbk = Callback(i['callback_query'])
-            for j in self._callback_handler_queue:
+            for j in self.dispatcher.callback_handlers(clbk):
                 j(clbk)
         
 
@@ -195,34 +576,228 @@ class BotHandler:
         '''
         Decorator for functions that wait for recieve a message.
         '''
-        def wrapper(message : Message):
-                    func(message)  
-        self._message_handler_queue.append(wrapper)
-        return wrapper
+        self.dispatcher.add_message_handler(metrics.timed('handler_seconds', handler=func.__name__)(func))
+        return func
     
 
-    def recieve_command_decorator(self, command : str):
+    def recieve_command_decorator(self, command : str, coalesce : bool = False):
         '''
         Decorator fabric for function that waiting to recieve command.
+        Set coalesce for idempotent commands, so repeated messages with them are handled once.
         '''
         def decorator(func):
-            def wrapper(message : Message):
-                if command in message.text:
-                    func(message)
-            self._message_handler_queue.append(wrapper)
-            return wrapper
+            self.dispatcher.add_command_handler(command, metrics.timed('handler_seconds', handler=command)(func), coalesce)
+            return func
         return decorator
 
 
-    def recieve_callback_decorator(self, callback_handler_name = None):
+    def recieve_callback_decorator(self, callback_handler_name = None, coalesce : bool = False):
         '''
         Decorator for functions that wait for recieve a callback.
+        Set coalesce for idempotent handlers, so repeated callbacks on the same message are handled once.
         '''
         def decorator(func):
-            def wrapper(callback : Callback):
-                if callback.handler == callback_handler_name:
-                    func(callback)  
-            self._callback_handler_queue.append(wrapper)
-            return wrapper
+            self.dispatcher.add_callback_handler(
+                callback_handler_name, metrics.timed('handler_seconds', handler=f'callback:{callback_handler_name}')(func),
+                coalesce)
+            return func
         return decorator
 
+
+class PagedKeyboard:
+    '''
+    Inline keyboard with one button per item, split into pages with prev and next buttons.
+    Pages come from keyset function fetch_page(chat_id, after, before, limit) -> (items, more),
+    so every page costs one bounded query and message size is bounded by page_size.
+    Item buttons call handler_name with item as data, prev and next buttons edit keyboard in place.
+    '''
+
+    def __init__(self, bot : BotHandler, handler_name : str, text : str, fetch_page : Callable,
+                 page_size : int = 8, header : List[List[InlineButton]] = None):
+        '''
+        PagedKeyboard constructor, registers page callback on bot.
+        header rows, e.g. Cancel button, are shown above items on every page.
+        '''
+        self.bot = bot
+        self.handler_name = handler_name
+        self.text = text
+        self.fetch_page = fetch_page
+        self.page_size = page_size
+        self.header = header or []
+        self.page_handler_name = f'{handler_name}_page'
+        bot.recieve_callback_decorator(self.page_handler_name, coalesce=True)(self.page_callback)
+
+    def buttons(self, chat_id : int, after : str = None, before : str = None) -> List[List[InlineButton]]:
+        '''
+        Get buttons of page after item after or before item before, first page by default.
+        '''
+        items, more = self.fetch_page(chat_id, after, before, self.page_size)
+        if before is not None:
+            has_prev, has_next = more, True
+        else:
+            has_prev, has_next = after is not None, more
+        buttons = list(self.header)
+        buttons.extend([InlineButton(i, i, self.handler_name)] for i in items)
+        navigation = []
+        if has_prev and items:
+            navigation.append(InlineButton('⬅️', '<' + items[0], self.page_handler_name))
+        if has_next and items:
+            navigation.append(InlineButton('➡️', '>' + items[-1], self.page_handler_name))
+        if navigation:
+            buttons.append(navigation)
+        return buttons
+
+    def send(self, chat_id : int, items : List[str] = None) -> Dict:
+        '''
+        Send first page to chat, or only selected items, e.g. search results, without pages.
+        '''
+        if items is None:
+            buttons = self.buttons(chat_id)
+        else:
+            buttons = self.header + [[InlineButton(i, i, self.handler_name)] for i in items]
+        return self.bot.send_inline_keyboard(chat_id, self.text, buttons)
+
+    def page_callback(self, callback : Callback) -> None:
+        '''
+        Show previous or next page in the same message.
+        '''
+        data = callback.data or ''
+        direction, key = data[:1], data[1:]
+        if direction == '<':
+            buttons = self.buttons(callback.chat_id, before=key)
+        else:
+            buttons = self.buttons(callback.chat_id, after=key)
+        self.bot.edit_message(callback.chat_id, callback.message.message_id, self.text,
+                              self.bot.keyboard_markup(buttons))
+
+
+class _WebhookRequestHandler(BaseHTTPRequestHandler):
+    '''
+    Http handler that passes telegram updates to bot of WebhookServer.
+    '''
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status : int, body : bytes = b'', content_type : str = 'text/plain') -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        webhook = self.server.webhook
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != webhook.path:
+            return self._reply(404)
+        if webhook.secret_token and not hmac.compare_digest(
+                self.headers.get(SECRET_TOKEN_HEADER, ''), webhook.secret_token):
+            return self._reply(403)
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return self._reply(400)
+        #blocks when dispatcher is behind, so telegram slows down instead of memory growing
+        webhook.updates.put(update)
+        self._reply(200)
+
+    def do_GET(self):
+        route = self.server.webhook.routes.get(urlsplit(self.path).path)
+        if route is None:
+            return self._reply(404)
+        content_type, body = route()
+        self._reply(200, body.encode(), content_type)
+
+
+class WebhookServer:
+    '''
+    Threaded http server that recieves updates from telegram webhook and queues them,
+    one dispatcher thread passes queued updates in batches to BotHandler.handle_updates,
+    so updates are handled in order like in polling. Extra GET routes can be added to routes,
+    /metrics is served by default.
+    '''
+
+    def __init__(self, bot : BotHandler, host : str = '0.0.0.0', port : int = 8443, path : str = '/',
+                 secret_token : str = None, queue_size : int = 10000, batch_size : int = 100):
+        '''
+        WebhookServer constructor.
+        Updates are accepted only on path and only with secret_token in header, if it is set.
+        At most queue_size updates wait for dispatcher, it takes up to batch_size of them at once.
+        '''
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self.batch_size = batch_size
+        self.updates = queue.Queue(queue_size)
+        self._dispatcher = None
+        #path -> function returning (content type, body)
+        self.routes = {'/metrics': metrics.exposition}
+        self._server = ThreadingHTTPServer((host, port), _WebhookRequestHandler)
+        self._server.daemon_threads = True
+        self._server.webhook = self
+        self._thread = None
+
+    @property
+    def server_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def _start_dispatcher(self) -> None:
+        if self._dispatcher is None:
+            self._dispatcher = threading.Thread(target=self._dispatch, name='webhook-dispatcher', daemon=True)
+            self._dispatcher.start()
+
+    def _dispatch(self) -> None:
+        '''
+        Pass queued updates to bot until None comes from queue.
+        '''
+        while True:
+            batch = [self.updates.get()]
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.updates.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            if batch:
+                try:
+                    self.bot.handle_updates(batch)
+                except Exception as e:
+                    #telegram would resend failed update again and again
+                    print(f'Webhook handler error: {e!r}')
+            if stop:
+                return
+
+    def serve_forever(self) -> None:
+        '''
+        Serve in current thread.
+        '''
+        self._start_dispatcher()
+        self._server.serve_forever()
+
+    def start(self) -> 'WebhookServer':
+        '''
+        Serve in background thread.
+        '''
+        self._start_dispatcher()
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        '''
+        Stop server, dispatcher finishes queued updates.
+        '''
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread = None
+        self._server.server_close()
+        if self._dispatcher is not None:
+            self.updates.put(None)
+            self._dispatcher.join()
+            self._dispatcher = None
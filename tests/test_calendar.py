@@ -0,0 +1,68 @@
+import datetime
+import random
+
+import pytest
+
+from database import Database
+
+
+@pytest.fixture
+def dbs(tmp_path):
+    '''
+    Database with CalendarIndex and plain Database on the same file.
+    '''
+    file_name = str(tmp_path / 'test.db')
+    sql = Database(file_name, chat_cache_size=0)
+    rand = random.Random(1)
+    rows = []
+    for i in range(600):
+        date = datetime.date(2000, 1, 1) + datetime.timedelta(days=rand.randrange(366))
+        rows.append((f'n{i}', f'{date:%d.%m}.{rand.randrange(1950, 2020)}', rand.randrange(5)))
+    rows.append(('leap', '29.02.2000', 0))
+    sql.add_birthdays(rows)
+    index = Database(file_name, chat_cache_size=0, calendar_index=True)
+    yield index, sql
+    index.close()
+    sql.close()
+
+
+def same(first, second):
+    return sorted(map(repr, first)) == sorted(map(repr, second))
+
+
+DAYS = [datetime.date(2023, 1, 1), datetime.date(2023, 2, 28), datetime.date(2024, 2, 28),
+        datetime.date(2024, 2, 29), datetime.date(2023, 12, 25), datetime.date(2023, 7, 14)]
+
+
+def test_index_matches_sql(dbs):
+    index, sql = dbs
+    assert len(index.calendar) == 601
+    for day in DAYS:
+        date = day.strftime('%d.%m.%Y')
+        assert same(index.get_birthdays_by_date(date), sql.get_birthdays_by_date(date))
+        for chat_id in range(6):
+            for days in (0, 7, 30, 366):
+                assert index.get_upcoming(chat_id, days, day) == sql.get_upcoming(chat_id, days, day)
+    for chat_id in range(6):
+        assert same(index.get_chat_birthdays(chat_id), sql.get_chat_birthdays(chat_id))
+
+
+def test_index_follows_writes(dbs):
+    index, sql = dbs
+    index.add_birthday('new', '14.07.1990', 1)
+    index.add_birthdays([('new', '1.1.2000', 2), ('n0', '1.1.2000', 9)])
+    index.del_birthday('leap', 0)
+    for chat_id in (0, 1, 2, 9):
+        assert same(index.get_chat_birthdays(chat_id), sql.get_chat_birthdays(chat_id))
+        assert index.get_upcoming(chat_id, 366, DAYS[0]) == sql.get_upcoming(chat_id, 366, DAYS[0])
+    for date in ('14.07.2023', '01.01.2023', '29.02.2024'):
+        assert same(index.get_birthdays_by_date(date), sql.get_birthdays_by_date(date))
+
+
+def test_index_loads_only_selected_chats(tmp_path):
+    db = Database(str(tmp_path / 'test.db'))
+    db.add_birthdays([('a', '1.1.2000', 1), ('b', '1.1.2000', 2)])
+    db.load_calendar(lambda chat_id: chat_id == 2)
+    assert [i.name for i in db.get_birthdays_by_date('1.1.2023')] == ['b']
+    assert db.get_chat_birthdays(1) == ()
+    db.close()
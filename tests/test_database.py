@@ -0,0 +1,182 @@
+from concurrent.futures import Future
+import datetime
+import sqlite3
+import threading
+
+import pytest
+
+from database import Database
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / 'test.db'))
+    yield db
+    db.close()
+
+
+def old_database(file_name, rows):
+    conn = sqlite3.connect(file_name)
+    with conn:
+        conn.execute('''CREATE TABLE "birthdays" (
+        "hash"	text NOT NULL UNIQUE,
+        "name"	text NOT NULL,
+        "date"	text NOT NULL,
+        "chat_id"	long NOT NULL
+        );''')
+        conn.executemany('INSERT INTO birthdays VALUES (?,?,?,?)',
+            [(f'{name}:{chat_id}', name, date, chat_id) for name, date, chat_id in rows])
+    conn.close()
+
+
+def test_migrate_fills_month_and_day_of_old_database(tmp_path):
+    file_name = str(tmp_path / 'old.db')
+    old_database(file_name, [('a', '01.02.2000', 1), ('b', '01.02.1990', 2), ('c', '02.01.2000', 1)])
+    db = Database(file_name)
+    rows = db.connection().execute('SELECT name, month, day FROM birthdays ORDER BY name').fetchall()
+    assert rows == [('a', 2, 1), ('b', 2, 1), ('c', 1, 2)]
+    assert sorted(i.name for i in db.get_birthdays_by_date('1.2.2023')) == ['a', 'b']
+    db.close()
+
+
+def test_get_birthdays_by_date_uses_month_day_index(tmp_path):
+    file_name = str(tmp_path / 'old.db')
+    old_database(file_name, [])
+    db = Database(file_name)
+    plan = db.connection().execute('EXPLAIN QUERY PLAN SELECT name, date, chat_id FROM birthdays WHERE month=? AND day=?',
+        (1, 1)).fetchall()
+    assert 'birthdays_month_day' in plan[0][-1]
+    #second open doesn't fail on existing columns
+    Database(file_name).close()
+    db.close()
+
+
+def test_new_birthday_gets_month_and_day(db):
+    db.add_birthday('a', '29.2.2000', 1)
+    assert db.connection().execute('SELECT month, day FROM birthdays').fetchall() == [(2, 29)]
+
+
+def names(b_list):
+    return sorted(i.name for i in b_list)
+
+
+def test_chat_birthdays_are_served_from_cache(db):
+    db.add_birthday('a', '1.1.2000', 1)
+    assert names(db.get_chat_birthdays(1)) == ['a']
+    assert db.get_chat_birthdays(1) is db.get_chat_birthdays(1)
+    assert db.cache_info()['hits'] == 2
+
+
+def test_add_and_del_invalidate_only_their_chat(db):
+    db.add_birthday('a', '1.1.2000', 1)
+    db.add_birthday('b', '1.1.2000', 2)
+    chat2 = db.get_chat_birthdays(2)
+    assert names(db.get_chat_birthdays(1)) == ['a']
+    db.add_birthday('c', '2.1.2000', 1)
+    assert names(db.get_chat_birthdays(1)) == ['a', 'c']
+    db.add_birthdays([('d', '3.1.2000', 1)])
+    assert names(db.get_chat_birthdays(1)) == ['a', 'c', 'd']
+    db.del_birthday('a', 1)
+    assert names(db.get_chat_birthdays(1)) == ['c', 'd']
+    assert db.get_birthday('a', 1) is None
+    assert db.get_chat_birthdays(2) is chat2
+
+
+def test_failed_add_invalidates_cache(db):
+    db.add_birthday('a', '1.1.2000', 1)
+    db.get_chat_birthdays(1)
+    with pytest.raises(KeyError):
+        db.add_birthday('a', '2.1.2000', 1)
+    misses = db.cache_info()['misses']
+    assert names(db.get_chat_birthdays(1)) == ['a']
+    assert db.cache_info()['misses'] == misses + 1
+
+
+def test_celebrated_dates_are_replaced_and_filtered(db):
+    db.set_celebrated({1: datetime.date(2023, 5, 9), 2: datetime.date(2023, 5, 9)})
+    db.set_celebrated({1: datetime.date(2023, 5, 10)})
+    assert db.get_celebrated(datetime.date(2023, 5, 10)) == {1: datetime.date(2023, 5, 10)}
+    assert len(db.get_celebrated(datetime.date(2023, 1, 1))) == 2
+
+
+def test_days_left_map_wraps_over_new_year():
+    days_left = Database.days_left_map(datetime.date(2023, 12, 30), 3)
+    assert days_left == {(12, 30): 0, (12, 31): 1, (1, 1): 2, (1, 2): 3}
+
+
+def test_days_left_map_celebrates_29_february_on_28_in_non_leap_year():
+    days_left = Database.days_left_map(datetime.date(2023, 2, 27), 2)
+    assert days_left == {(2, 27): 0, (2, 28): 1, (2, 29): 1, (3, 1): 2}
+
+
+def test_days_left_map_in_leap_year():
+    days_left = Database.days_left_map(datetime.date(2024, 2, 27), 2)
+    assert days_left == {(2, 27): 0, (2, 28): 1, (2, 29): 2}
+
+
+def test_days_left_map_covers_whole_year():
+    assert len(Database.days_left_map(datetime.date(2023, 1, 1), 1000)) == 366
+
+
+def test_get_upcoming_wraps_over_new_year(db):
+    db.add_birthdays([('a', '30.12.1990', 1), ('b', '2.1.1990', 1), ('c', '3.1.1990', 1), ('d', '1.1.1990', 2)])
+    upcoming = db.get_upcoming(1, 3, datetime.date(2023, 12, 30))
+    assert [(i.name, days) for i, days in upcoming] == [('a', 0), ('b', 3)]
+
+
+def test_get_upcoming_sorts_by_days_and_name(db):
+    db.add_birthdays([('b', '29.2.2000', 1), ('a', '28.2.1990', 1), ('c', '1.3.1990', 1)])
+    upcoming = db.get_upcoming(1, 366, datetime.date(2023, 2, 27))
+    assert [(i.name, days) for i, days in upcoming] == [('a', 1), ('b', 1), ('c', 2)]
+
+
+def write(func, *args):
+    return (func, args, Future())
+
+
+def test_commit_group_isolates_failed_write(db):
+    def fail(conn):
+        raise KeyError('fail')
+
+    group = [write(Database._insert_birthday, db.birthday_row('a', '1.1.2000', 1)),
+             write(fail),
+             write(Database._insert_birthday, db.birthday_row('b', '2.1.2000', 1))]
+    db._commit_group(db.connection(), group)
+    assert group[0][2].result() is None
+    with pytest.raises(KeyError):
+        group[1][2].result()
+    assert group[2][2].result() is None
+    assert sorted(i.name for i in db.get_chat_birthdays(1)) == ['a', 'b']
+
+
+def test_commit_group_duplicate_fails_only_its_write(db):
+    db.add_birthday('a', '1.1.2000', 1)
+    group = [write(Database._insert_birthday, db.birthday_row('a', '3.1.2000', 1)),
+             write(Database._insert_birthday, db.birthday_row('c', '3.1.2000', 1))]
+    db._commit_group(db.connection(), group)
+    with pytest.raises(KeyError):
+        group[0][2].result()
+    assert group[1][2].result() is None
+    assert db.get_birthday('a', 1).birth_date == '01.01.2000'
+
+
+def test_commit_group_failed_commit_fails_every_write(db):
+    conn = db.connection()
+    conn.execute('BEGIN')
+    group = [write(Database._insert_birthday, db.birthday_row('a', '1.1.2000', 1))]
+    #BEGIN IMMEDIATE inside open transaction fails
+    db._commit_group(conn, group)
+    assert group[0][2].exception() is not None
+    assert not conn.in_transaction
+
+
+def test_concurrent_writes_are_all_committed(db):
+    def add(thread):
+        for i in range(20):
+            db.add_birthday(f'{thread}-{i}', '1.1.2000', thread)
+    threads = [threading.Thread(target=add, args=(i,)) for i in range(10)]
+    for i in threads:
+        i.start()
+    for i in threads:
+        i.join()
+    assert len(db.get_all_birthdays()) == 200
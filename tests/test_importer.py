@@ -0,0 +1,64 @@
+import io
+
+import pytest
+
+from database import Database
+from importer import import_birthdays, read_csv, read_json, read_jsonl
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / 'test.db'))
+    yield db
+    db.close()
+
+
+def test_read_csv_falls_back_to_chat_id_for_missing_or_empty_column():
+    rows = list(read_csv(io.StringIO('A,1.1.2000\nB,2.2.2000,\nC,3.3.2000, 7\n#comment\n'), 5))
+    assert rows == [('A', '1.1.2000', 5), ('B', '2.2.2000', 5), ('C', '3.3.2000', '7')]
+
+
+def test_read_json_reads_array():
+    rows = list(read_json(io.StringIO('[{"name": "A", "birth_date": "1.1.2000"}, '
+                                      '{"name": "B", "birth_date": "2.2.2000", "chat_id": 7}, 1]'), 5))
+    assert rows[:2] == [('A', '1.1.2000', 5), ('B', '2.2.2000', 7)]
+    assert isinstance(rows[2], ValueError)
+
+
+@pytest.mark.parametrize('text', ['{"name": "A"}\n{"name": "B"}\n', '{"name": "A"}'])
+def test_read_json_reports_file_that_is_not_array(text):
+    rows = list(read_json(io.StringIO(text)))
+    assert len(rows) == 1 and isinstance(rows[0], ValueError)
+
+
+def test_read_jsonl_reports_broken_line_as_its_row():
+    rows = list(read_jsonl(io.StringIO('{"name": "A", "birth_date": "1.1.2000"}\n{broken\n\n[1]\n'), 5))
+    assert rows[0] == ('A', '1.1.2000', 5)
+    assert [type(i) for i in rows[1:]] == [ValueError, ValueError]
+
+
+def test_add_birthdays_reports_errors_of_rows(db):
+    db.add_birthday('old', '1.1.2000', 1)
+    errors = db.add_birthdays([
+        ('a', '1.1.2000', 1),
+        ('b', '31.02.2000', 1),
+        ('c', '1.1.2000', 'chat'),
+        ('d', '1.1.2000'),
+        (1, '1.1.2000', 1),
+        ValueError('Wrong json'),
+        ('old', '2.2.2000', 1),
+        ('a', '3.3.2000', '1'),
+        ('e', '4.4.2000', '2'),
+        ])
+    assert [(index, type(error)) for index, error in errors] == [
+        (1, ValueError), (2, ValueError), (3, ValueError), (4, ValueError), (5, ValueError),
+        (6, KeyError), (7, KeyError)]
+    assert 'Wrong date' in str(errors[0][1]) and 'Wrong chat_id' in str(errors[1][1])
+    assert sorted((i.name, i.chat_id) for i in db.get_all_birthdays()) == [('a', 1), ('e', 2), ('old', 1)]
+
+
+def test_import_birthdays_numbers_errors_across_batches(db):
+    rows = [(f'n{i}', '1.1.2000', 1) for i in range(5)] + [('n0', '1.1.2000', 1)]
+    added, errors = import_birthdays(db, rows, batch_size=2)
+    assert added == 5
+    assert [index for index, _ in errors] == [5]
@@ -0,0 +1,59 @@
+import json
+import time
+
+import offsets
+from offsets import OffsetStore
+
+
+def test_mark_moves_offset_and_skips_seen():
+    store = OffsetStore()
+    assert store.offset is None
+    store.mark(5)
+    store.mark(3)
+    assert store.offset == 6
+    assert store.seen(3) and store.seen(5) and not store.seen(4)
+
+
+def test_seen_keeps_only_recent_updates():
+    store = OffsetStore(seen_size=2)
+    for i in range(3):
+        store.mark(i)
+    assert not store.seen(0) and store.seen(1) and store.seen(2)
+
+
+def test_commit_every_writes_file_and_store_loads_it(tmp_path):
+    file_name = str(tmp_path / 'offset.json')
+    store = OffsetStore(file_name, commit_every=2, commit_interval=60)
+    store.mark(1)
+    store.mark(2)
+    loaded = OffsetStore(file_name)
+    assert loaded.offset == 3
+    assert loaded.seen(1) and loaded.seen(2)
+    store.close()
+
+
+def test_timer_commits_after_interval(tmp_path):
+    file_name = tmp_path / 'offset.json'
+    store = OffsetStore(str(file_name), commit_every=100, commit_interval=0.05)
+    store.mark(7)
+    deadline = time.monotonic() + 5
+    while not file_name.exists() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert json.loads(file_name.read_text())['offset'] == 8
+    store.close()
+
+
+def test_close_commits_and_old_state_is_ignored(tmp_path, monkeypatch):
+    file_name = str(tmp_path / 'offset.json')
+    store = OffsetStore(file_name, commit_every=100, commit_interval=60)
+    store.mark(1)
+    store.close()
+    assert OffsetStore(file_name).offset == 2
+    monkeypatch.setattr(offsets, 'MAX_AGE', -1)
+    assert OffsetStore(file_name).offset is None
+
+
+def test_broken_file_is_ignored(tmp_path):
+    file_name = tmp_path / 'offset.json'
+    file_name.write_text('{broken')
+    assert OffsetStore(str(file_name)).offset is None
@@ -0,0 +1,107 @@
+import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from database import Birthday
+from scheduler import BirthdayScheduler, next_occurrence
+
+
+@pytest.mark.parametrize('birth_date, day, expected', [
+    ((1990, 5, 10), (2023, 5, 10), (2023, 5, 10)),
+    ((1990, 5, 10), (2023, 5, 11), (2024, 5, 10)),
+    ((1990, 1, 1), (2023, 12, 31), (2024, 1, 1)),
+    ((2000, 2, 29), (2024, 2, 1), (2024, 2, 29)),
+    ((2000, 2, 29), (2023, 2, 1), (2023, 2, 28)),
+    ((2000, 2, 29), (2023, 3, 1), (2024, 2, 29)),
+    ((2000, 2, 29), (2024, 3, 1), (2025, 2, 28)),
+    ])
+def test_next_occurrence(birth_date, day, expected):
+    assert next_occurrence(datetime.date(*birth_date), datetime.date(*day)) == datetime.date(*expected)
+
+
+def at(tz, *args):
+    return datetime.datetime(*args, tzinfo=ZoneInfo(tz)).timestamp()
+
+
+def birthday(name, month, day, chat_id=1):
+    return Birthday(name, datetime.date(1990, month, day), chat_id)
+
+
+@pytest.fixture
+def timezones():
+    return {1: 'UTC', 2: 'Asia/Tokyo', 3: 'UTC'}
+
+
+@pytest.fixture
+def scheduler(timezones):
+    return BirthdayScheduler(lambda b_list: None, timezone_of=timezones.get)
+
+
+def names(b_list):
+    return sorted(i.name for i in b_list)
+
+
+def test_load_makes_today_due_at_once(scheduler):
+    now = at('UTC', 2023, 5, 10, 12)
+    scheduler.load([birthday('today', 5, 10), birthday('tomorrow', 5, 11)], now)
+    assert names(scheduler.pop_due(now)) == ['today']
+    assert scheduler.pop_due(now) == []
+    assert scheduler.next_due() == at('UTC', 2023, 5, 11)
+    assert names(scheduler.pop_due(at('UTC', 2023, 5, 11))) == ['tomorrow']
+    #celebrated birthdays are scheduled for the next year
+    assert scheduler.next_due() == at('UTC', 2024, 5, 10)
+    assert len(scheduler) == 2
+
+
+def test_load_skips_today_of_celebrated_chats(scheduler):
+    now = at('UTC', 2023, 5, 10, 12)
+    b_list = [birthday('a', 5, 10, 1), birthday('b', 5, 10, 2), birthday('c', 5, 10, 3)]
+    #chat 3 was celebrated yesterday, so its today's birthday is still due
+    celebrated = {1: datetime.date(2023, 5, 10), 3: datetime.date(2023, 5, 9)}
+    scheduler.load(b_list, now, celebrated=celebrated)
+    assert names(scheduler.pop_due(now)) == ['b', 'c']
+    assert scheduler.next_due() == at('Asia/Tokyo', 2024, 5, 10)
+
+
+def test_add_replaces_and_remove_unschedules(scheduler):
+    now = at('UTC', 2023, 5, 10, 12)
+    scheduler.load([], now)
+    scheduler.add(birthday('a', 5, 10), now=now)
+    scheduler.add(birthday('a', 6, 1), now=now)
+    scheduler.add(birthday('b', 5, 10), skip_today=True, now=now)
+    scheduler.add(birthday('c', 5, 12), now=now)
+    scheduler.remove('c', 1)
+    assert scheduler.pop_due(now) == []
+    assert len(scheduler) == 2
+    assert scheduler.next_due() == at('UTC', 2023, 6, 1)
+
+
+def test_birthday_is_due_at_midnight_of_chat_timezone(scheduler):
+    now = at('UTC', 2023, 5, 9, 12)
+    scheduler.load([birthday('utc', 5, 10, 1), birthday('tokyo', 5, 10, 2)], now)
+    assert scheduler.next_due() == at('Asia/Tokyo', 2023, 5, 10)
+    assert names(scheduler.pop_due(at('UTC', 2023, 5, 9, 15))) == ['tokyo']
+    assert names(scheduler.pop_due(at('UTC', 2023, 5, 10))) == ['utc']
+
+
+def test_reschedule_chat_to_later_timezone_does_not_celebrate_again(scheduler, timezones):
+    b_day = birthday('a', 5, 10, 2)
+    scheduler.load([b_day], at('UTC', 2023, 5, 9, 12))
+    assert names(scheduler.pop_due(at('Asia/Tokyo', 2023, 5, 10, 1))) == ['a']
+    #it is still 9 May in New York, but the birthday was celebrated in Tokyo
+    timezones[2] = 'America/New_York'
+    now = at('UTC', 2023, 5, 9, 17)
+    scheduler.reschedule_chat([b_day], 'Asia/Tokyo', now)
+    assert scheduler.pop_due(at('America/New_York', 2023, 5, 10, 1)) == []
+    assert scheduler.next_due() == at('America/New_York', 2024, 5, 10)
+
+
+def test_reschedule_chat_to_earlier_timezone_moves_due_time(scheduler, timezones):
+    b_day = birthday('a', 5, 10, 1)
+    now = at('UTC', 2023, 5, 9, 12)
+    scheduler.load([b_day], now)
+    timezones[1] = 'Asia/Tokyo'
+    scheduler.reschedule_chat([b_day], 'UTC', now)
+    assert scheduler.next_due() == at('Asia/Tokyo', 2023, 5, 10)
+    assert len(scheduler) == 1
@@ -0,0 +1,86 @@
+import time
+
+import pytest
+
+from sender import SendQueue, TokenBucket
+
+
+class Response:
+    def __init__(self, status_code, json=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.headers = {}
+        self._json = json or {}
+
+    def json(self):
+        return self._json
+
+
+class FakeBot:
+    '''
+    Answers every message with next status from statuses, the last one repeats.
+    '''
+
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.calls = 0
+
+    def send_message(self, chat_id, text, markup=None):
+        self.calls += 1
+        status = self.statuses.pop(0) if len(self.statuses) > 1 else self.statuses[0]
+        if status == 429:
+            return Response(429, {'parameters': {'retry_after': 0}})
+        return Response(status)
+
+
+@pytest.fixture
+def make_queue():
+    queues = []
+
+    def make(bot, **kwargs):
+        queue = SendQueue(bot, workers=2, chat_rate=1000, **kwargs).start()
+        queues.append(queue)
+        return queue
+    yield make
+    for i in queues:
+        i.stop(timeout=5)
+
+
+@pytest.mark.parametrize('status', [400, 403])
+def test_client_error_fails_at_once(make_queue, status):
+    bot = FakeBot(status)
+    delivery = make_queue(bot).send_message(1, 'text')
+    assert delivery.wait(5)
+    assert delivery.status == 'failed' and delivery.error == f'HTTP {status}'
+    assert bot.calls == 1
+
+
+def test_too_many_requests_is_retried(make_queue):
+    bot = FakeBot(429, 200)
+    queue = make_queue(bot)
+    delivery = queue.send_message(1, 'text')
+    assert delivery.wait(5)
+    assert delivery.status == 'sent' and delivery.attempts == 2
+    assert queue.stats['too_many_requests'] == 1
+
+
+def test_server_error_is_retried(make_queue):
+    bot = FakeBot(502, 200)
+    queue = make_queue(bot)
+    #backoff of first retry is 2 seconds
+    delivery = queue.send_message(1, 'text')
+    assert delivery.wait(10)
+    assert delivery.status == 'sent' and bot.calls == 2
+
+
+def test_token_bucket_without_burst_keeps_rate():
+    bucket = TokenBucket(10, 1)
+    now = time.monotonic()
+    taken = 0
+    for i in range(100):
+        t = now + i*0.01
+        if bucket.wait_time(t) == 0:
+            bucket.take(t)
+            taken += 1
+    #one second at 10 per second, plus the single starting token
+    assert taken <= 11
@@ -0,0 +1,157 @@
+import pytest
+import requests
+
+from tbot import BotHandler, CallbackCodec, split_message, text_length, update_chat_id
+
+
+def message(update_id, text, chat_id=1):
+    return {'update_id': update_id, 'message': {'message_id': update_id, 'chat': {'id': chat_id},
+            'from': {'id': 10, 'first_name': 'first'}, 'text': text}}
+
+
+@pytest.fixture
+def bot():
+    bot = BotHandler('token', server='http://127.0.0.1:9', bot_name='birthday_bot')
+    yield bot
+    bot.close()
+
+
+@pytest.fixture
+def calls(bot):
+    calls = []
+    for command in ('/add', '/calc', '/list'):
+        bot.dispatcher.add_command_handler(command, lambda message, command=command: calls.append(command))
+    bot.dispatcher.add_message_handler(lambda message: calls.append('message'))
+    return calls
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('/add Вася 1.1.2000', ['message', '/add']),
+    ('/calc /add', ['message', '/calc']),
+    ('/calc@birthday_bot', ['message', '/calc']),
+    ('/calc@other_bot', ['message']),
+    ('/unknown', ['message']),
+    ('add /add', ['message']),
+    ('', ['message']),
+    ])
+def test_message_goes_to_handlers_of_its_leading_command(bot, calls, text, expected):
+    bot.process_updates([message(1, text)])
+    assert calls == expected
+
+
+def test_command_handlers_run_in_order_of_adding(bot, calls):
+    bot.dispatcher.add_command_handler('/add', lambda message: calls.append('second'))
+    bot.process_updates([message(1, '/add')])
+    assert calls == ['message', '/add', 'second']
+
+
+@pytest.mark.parametrize('handler, data', [
+    ('del', 'Вася'),
+    (None, 'Cancel'),
+    ('calc', ''),
+    ('del', 'x'*100),
+    ('page', {'after': 'a'}),
+    ('a:b', 'data'),
+    ('{x', 'data'),
+    ])
+def test_callback_codec_round_trip(handler, data):
+    codec = CallbackCodec()
+    callback_data = codec.encode(handler, data)
+    assert len(callback_data.encode()) <= CallbackCodec.max_bytes
+    assert codec.decode(callback_data) == (handler, data)
+
+
+def test_callback_codec_token_is_stable_and_unknown_token_decodes_to_none():
+    codec = CallbackCodec()
+    token = codec.encode('del', 'x'*100)
+    assert token == codec.encode('del', 'x'*100)
+    assert CallbackCodec().decode(token) == (None, None)
+
+
+def test_callback_codec_decodes_legacy_dict_repr():
+    codec = CallbackCodec()
+    assert codec.decode(repr({'handler': 'del', 'data': 'Вася'})) == ('del', 'Вася')
+
+
+def test_handle_updates_skips_replayed_updates(bot, calls):
+    bot.handle_updates([message(1, '/add'), message(2, '/calc')])
+    bot.handle_updates([message(2, '/calc'), message(3, '/list')])
+    assert calls == ['message', '/add', 'message', '/calc', 'message', '/list']
+    assert bot.offset_store.offset == 4
+
+
+@pytest.fixture
+def coalescing_bot(bot):
+    bot.dispatcher.add_command_handler('/list', lambda message: None, coalesce=True)
+    bot.dispatcher.add_command_handler('/add', lambda message: None)
+    return bot
+
+
+def test_coalesce_updates_merges_repeats_of_chat(coalescing_bot):
+    updates = [message(1, '/list'), message(2, '/list'), message(3, '/list', chat_id=2)]
+    assert [i['update_id'] for i in coalescing_bot.coalesce_updates(updates)] == [1, 3]
+
+
+def test_coalesce_updates_keeps_repeat_after_other_update(coalescing_bot):
+    updates = [message(1, '/list'), message(2, '/add a 1.1.2000'), message(3, '/list')]
+    assert [i['update_id'] for i in coalescing_bot.coalesce_updates(updates)] == [1, 2, 3]
+
+
+def test_coalesce_updates_without_window_merges_only_within_batch(coalescing_bot):
+    assert len(coalescing_bot.coalesce_updates([message(1, '/list')])) == 1
+    assert len(coalescing_bot.coalesce_updates([message(2, '/list')])) == 1
+
+
+def test_coalesce_updates_with_window_merges_across_batches(coalescing_bot):
+    coalescing_bot.coalesce_window = 60
+    assert len(coalescing_bot.coalesce_updates([message(1, '/list')])) == 1
+    assert len(coalescing_bot.coalesce_updates([message(2, '/list')])) == 0
+
+
+def test_split_message_joins_lines_under_limit():
+    assert split_message(['a', 'b', 'c'], 'head', limit=100) == ['head\na\nb\nc']
+
+
+def test_split_message_starts_every_message_with_header():
+    messages = split_message(['aaaa', 'bbbb', 'cccc'], 'hd', limit=10)
+    assert messages == ['hd\naaaa', 'hd\nbbbb', 'hd\ncccc']
+    assert all(text_length(i) <= 10 for i in messages)
+
+
+def test_split_message_cuts_long_line():
+    messages = split_message(['x'*25], limit=10)
+    assert messages == ['x'*10, 'x'*10, 'x'*5]
+
+
+def test_split_message_counts_utf16_units():
+    #every emoji is two UTF-16 code units and is never split
+    messages = split_message(['🎂'*5], limit=4)
+    assert messages == ['🎂🎂', '🎂🎂', '🎂']
+
+
+def test_split_message_without_lines():
+    assert split_message([], 'head') == ['head']
+    assert split_message([]) == []
+
+
+def test_update_chat_id():
+    assert update_chat_id(message(1, 'text', chat_id=5)) == 5
+    callback = {'update_id': 2, 'callback_query': {'id': '1', 'data': 'del:a', 'message': message(2, '')['message']}}
+    assert update_chat_id(callback) == 1
+    assert update_chat_id({'update_id': 3, 'edited_message': {}}) is None
+
+
+def test_run_polling_backs_off_on_connection_errors(bot, monkeypatch):
+    sleeps = []
+    results = [requests.exceptions.ConnectionError(), requests.exceptions.Timeout(), None,
+               requests.exceptions.ConnectionError(), KeyboardInterrupt()]
+
+    def polling():
+        result = results.pop(0)
+        if result is not None:
+            raise result
+    monkeypatch.setattr(bot, 'polling', polling)
+    monkeypatch.setattr('tbot.time.sleep', sleeps.append)
+    with pytest.raises(KeyboardInterrupt):
+        bot.run_polling()
+    assert sleeps == [1, 2, 1]